@@ -1,11 +1,12 @@
 import base64
-import matplotlib.pyplot as plt
+import time
+import numpy as np
 import scipy.io as sc
 import streamlit as st
 from PIL import Image
-import config
-import local_functions
-import model_functions
+import diagnosis_functions
+import plot_functions
+import session_pool
 import snowflake_functions
 
 im = Image.open("./images/heart.png")
@@ -25,15 +26,15 @@ if 'user_id' not in st.session_state:
 if 'file' not in st.session_state:
     st.session_state['file'] = None
 
+if 'files' not in st.session_state:
+    st.session_state['files'] = None
+
 if 'change' not in st.session_state:
     st.session_state['change'] = True
 
 if 'button_disabled' not in st.session_state:
     st.session_state['button_disabled'] = False
 
-if 'session' not in st.session_state:
-    st.session_state['session'] = snowflake_functions.get_session(initialize=False)
-
 if 'patient_id' not in st.session_state:
     st.session_state['patient_id'] = None
 
@@ -41,6 +42,12 @@ if 'current_tab' not in st.session_state:
     st.session_state['current_tab'] = 'Home'
 
 
+@st.cache_resource
+def get_session_pool():
+    # One pool for the whole server process, callbacks borrow a session from it for the work they do
+    return session_pool.SessionPool(snowflake_functions.create_session)
+
+
 def show_gif(gif):
     st.markdown(
         f'<img src="data:data:image/gif;base64,{gif}" alt="mushroom gif" width="50%">',
@@ -56,37 +63,34 @@ def get_gif(location):
     return gif
 
 
-def show_plot():
-    # Change height and width of plot
-    f = plt.figure()
-    f.set_figwidth(15)
-    f.set_figheight(5)
-    plt.plot(lead)
-    st.pyplot(plt)
+@st.cache_data(max_entries=32, show_spinner=False)
+def get_ecg_plot(patient_id, time_series):
+    # One downsampled 12-lead image per patient, reruns of the Analyse tab reuse it
+    return plot_functions.render_ecg_grid(time_series)
 
 
 def load_patient_ecg():
-    st.session_state['patient_id'] = snowflake_functions.get_next_patient_id(st.session_state['session'])
-    st.session_state['session'].sql(
-        f'INSERT INTO {config.fact_patient} '
-        f'VALUES (\'{st.session_state["patient_id"]}\', 1, \'X\')').collect()
-    df = local_functions.convert_mat_to_df(st.session_state['file'], st.session_state['patient_id'])
-    st.session_state['session'].write_pandas(df=df, table_name=config.dim_lead, overwrite=False)
+    # All uploaded files become patients of the user at once, the first one is shown
+    files = st.session_state['files'] or [st.session_state['file']]
+    with get_session_pool().session() as session:
+        patient_ids = snowflake_functions.ingest_patients(files, st.session_state['user_id'], session)
+    st.session_state['patient_id'] = patient_ids[0]
+    st.session_state['files'] = None
     st.session_state["change"] = False
-    snowflake_functions.add_patient_to_user(st.session_state['patient_id'], st.session_state['user_id'],
-                                            st.session_state['session'])
     st.experimental_rerun()
 
 
 def login_user(username, password):
-    id = snowflake_functions.login(username, password, st.session_state['session'])
+    with get_session_pool().session() as session:
+        id = snowflake_functions.login(username, password, session)
     if not (id is None or id == 0):
         st.session_state['signed_in'] = True
         st.session_state['user_id'] = id
 
 
 def register_user(firstname, lastname, username, password):
-    snowflake_functions.register(firstname, lastname, username, password, st.session_state['session'])
+    with get_session_pool().session() as session:
+        snowflake_functions.register(firstname, lastname, username, password, session)
     login_user(username, password)
 
 
@@ -163,26 +167,28 @@ else:
         show_gif(gif)
 
     if st.session_state['current_tab'] == 'Patients':
-        patient_ids = snowflake_functions.get_all_patients(st.session_state['user_id'], st.session_state['session'])
+        with get_session_pool().session() as session:
+            patient_ids = snowflake_functions.get_all_patients(st.session_state['user_id'], session)
         selected_id = st.selectbox(label="Select a patient to inspect:", options=patient_ids)
         if st.button("Inspect"):
             with st.spinner("loading patient..."):
                 st.session_state['patient_id'] = selected_id
-                st.session_state['file'] = snowflake_functions.get_tensions(st.session_state['patient_id'],
-                                                                            st.session_state['session'])
+                with get_session_pool().session() as session:
+                    st.session_state['file'] = snowflake_functions.get_tensions(st.session_state['patient_id'],
+                                                                                session)
                 st.session_state['current_tab'] = 'Upload'
                 st.session_state['button_disabled'] = True
                 st.experimental_rerun()
 
     if st.session_state['current_tab'] == 'Upload':
         if st.session_state['file'] is None:
-            file = st.file_uploader(accept_multiple_files=False,
-                                    label="Upload your file to get a diagnosis.",
-                                    type=['mat'])
+            files = st.file_uploader(accept_multiple_files=True,
+                                     label="Upload your files to get a diagnosis.",
+                                     type=['mat'])
 
-            if file is not None:
-                mat = sc.loadmat(file)
-                st.session_state['file'] = mat['val']
+            if files:
+                st.session_state['files'] = [sc.loadmat(file)['val'] for file in files]
+                st.session_state['file'] = st.session_state['files'][0]
                 st.session_state['button_disabled'] = True
                 st.experimental_rerun()
 
@@ -196,7 +202,8 @@ else:
             with tab1:
                 st.session_state['button_disabled'] = False
                 st.subheader("Please fill in some extra information about your patient: ")
-                df = snowflake_functions.get_age_and_gender(st.session_state['patient_id'], st.session_state['session'])
+                with get_session_pool().session() as session:
+                    df = snowflake_functions.get_age_and_gender(st.session_state['patient_id'], session)
                 patient_age = df['AGE'][0]
                 patient_gender = df['GENDER'][0]
                 age = st.number_input(label="Age: ", min_value=1, max_value=120, value=patient_age)
@@ -204,33 +211,29 @@ else:
                 gender = st.selectbox(label='Gender: ', options=options, index=options.index(patient_gender))
 
                 if st.button('Save'):
-                    snowflake_functions.update_patient(age, gender, st.session_state["patient_id"],
-                                                       st.session_state["session"])
+                    with get_session_pool().session() as session:
+                        snowflake_functions.update_patient(age, gender, st.session_state["patient_id"], session)
 
             with tab2:
                 st.subheader("Here are the plots of your patient.")
                 # Making the plot
-                time_series = st.session_state['file']
-
-                col1, col2, col3, col4 = st.columns(4)
-
-                with col1:
-                    for lead in time_series[0:3]:
-                        show_plot()
-                with col2:
-                    for lead in time_series[3:6]:
-                        show_plot()
-                with col3:
-                    for lead in time_series[6:9]:
-                        show_plot()
-                with col4:
-                    for lead in time_series[9:12]:
-                        show_plot()
+                time_series = np.asarray(st.session_state['file'])
+                st.image(get_ecg_plot(st.session_state['patient_id'], time_series), use_column_width=True)
 
             with tab3:
-                with st.spinner('Calculating diagnosis...'):
-                    diagnoses = model_functions.predict_with_patient_id(st.session_state['session'],
-                                                                        st.session_state['patient_id'])
+                # The diagnosis runs in the background, the Patient and Analyse tabs are drawn already. A widget
+                # change stops the wait below and the rerun finds the same diagnosis job again.
+                diagnosis = diagnosis_functions.submit_diagnosis(get_session_pool(), st.session_state['patient_id'])
+                message = st.empty()
+                while not diagnosis.done():
+                    message.info('Calculating diagnosis...')
+                    time.sleep(0.2)
+                message.empty()
+
+                if diagnosis.exception() is not None:
+                    st.error(f'The diagnosis could not be calculated: {diagnosis.exception()}')
+                else:
+                    diagnoses = diagnosis.result()
                     if diagnoses.empty:
                         st.write('We have not found any diseases for this patient.')
                     else:
@@ -0,0 +1,394 @@
+import csv
+import io
+import os
+import tempfile
+import timeit
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import scipy.io as sc
+
+import bulk_functions
+import config
+import header_functions
+import local_functions
+import model_functions
+import plot_functions
+import query_cache
+import signal_functions
+import snowflake_functions
+import store_functions
+from local_session import LocalSession
+
+
+def benchmark(label, function, number):
+    seconds = min(timeit.repeat(function, number=number, repeat=3)) / number
+    print(f'\t{label}: {seconds * 1000:.2f} ms')
+    return seconds
+
+
+def get_random_time_series(seed=0):
+    # A fake record with the same shape and value range as the 'val' array of a .mat file
+    return np.random.default_rng(seed).integers(-5000, 5000, size=(12, 5000)).astype(np.int16)
+
+
+def write_mat_rows_legacy(file_name, time_series, writer):
+    # Row emission of write_mat_file_to_csv before it was vectorized
+    for i in range(12):
+        row_data = [(file_name, i * 5000 + j + 1, time_series[i][j]) for j in range(5000)]
+        writer.writerows(row_data)
+
+
+def benchmark_write_mat_file_to_csv(number=20):
+    time_series = get_random_time_series()
+
+    def legacy():
+        buffer = io.StringIO(newline='')
+        write_mat_rows_legacy('JS00001', time_series, csv.writer(buffer))
+        return buffer.getvalue()
+
+    def vectorized():
+        return local_functions.format_mat_rows('JS00001', time_series)
+
+    if legacy() != vectorized():
+        raise ValueError('The vectorized rows are not identical to the csv.writer rows')
+
+    print('Writing the rows of one record (12x5000 tensions):')
+    legacy_seconds = benchmark('csv.writer', legacy, number)
+    vectorized_seconds = benchmark('NumPy byte block', vectorized, number)
+    print(f'\tSpeedup: {legacy_seconds / vectorized_seconds:.1f}x')
+
+
+def get_tensions_legacy(patient_id, session):
+    # get_tensions before it was vectorized
+    query = session.sql(
+        f'SELECT l.tension FROM {config.dim_lead} AS l WHERE patient_id = \'{patient_id}\' ORDER BY l.timestamp')
+    df = query.to_pandas()
+    data = []
+    for i in range(12):
+        lead = []
+        for j in range(5000):
+            lead.append(df["TENSION"].iloc[i * 5000 + j])
+        data.append(lead)
+
+    return data
+
+
+def convert_mat_to_df_legacy(uploaded_file, patient_id):
+    # convert_mat_to_df before it was vectorized
+    data = []
+
+    for i in range(12):
+        for j in range(5000):
+            data.append(uploaded_file[i][j])
+
+    return pd.DataFrame({'PATIENT_ID': patient_id, 'TIMESTAMP': range(60000), 'TENSION': data})
+
+
+def benchmark_get_tensions(number=5):
+    # One patient in the long dim_lead layout of an in-memory local database
+    time_series = get_random_time_series()
+    with tempfile.TemporaryDirectory() as directory:
+        session = LocalSession(':memory:', directory)
+        snowflake_functions.create_dim_lead_table(session)
+        session.write_pandas(df=local_functions.convert_mat_to_df(time_series, 'BENCH01'), table_name=config.dim_lead)
+
+        def legacy():
+            return get_tensions_legacy('BENCH01', session)
+
+        def vectorized():
+            return snowflake_functions.get_tensions('BENCH01', session)
+
+        if not np.array_equal(np.asarray(legacy()), vectorized()):
+            raise ValueError('The vectorized tensions are not identical to the legacy tensions')
+
+        print('Getting the tensions of one patient (query and conversion):')
+        legacy_seconds = benchmark('Double loop over iloc', legacy, number)
+        vectorized_seconds = benchmark('NumPy reshape', vectorized, number)
+        print(f'\tSpeedup: {legacy_seconds / vectorized_seconds:.1f}x')
+        session.close()
+
+
+def benchmark_convert_mat_to_df(number=5):
+    time_series = get_random_time_series()
+
+    def legacy():
+        return convert_mat_to_df_legacy(time_series, 'JS00001')
+
+    def vectorized():
+        return local_functions.convert_mat_to_df(time_series, 'JS00001')
+
+    legacy_df, vectorized_df = legacy(), vectorized()
+    if not all(np.array_equal(legacy_df[column].to_numpy(), vectorized_df[column].to_numpy()) for column in legacy_df):
+        raise ValueError('The vectorized dataframe does not have the same rows as the legacy dataframe')
+
+    print('Converting an uploaded .mat file to a dim_lead dataframe:')
+    legacy_seconds = benchmark('Appending 60000 items', legacy, number)
+    vectorized_seconds = benchmark('NumPy ravel', vectorized, number)
+    print(f'\tSpeedup: {legacy_seconds / vectorized_seconds:.1f}x')
+
+
+def show_plots_legacy(time_series):
+    # The 12 figures of the Analyse tab before the plots were cached, st.pyplot saves every figure as a png
+    for lead in time_series:
+        f = plt.figure()
+        f.set_figwidth(15)
+        f.set_figheight(5)
+        plt.plot(lead)
+        plt.savefig(io.BytesIO(), format='png')
+
+
+def benchmark_ecg_plot(number=3):
+    time_series = get_random_time_series()
+    print('Rendering the 12 leads of the Analyse tab:')
+    benchmark('12 figures of 5000 points', lambda: show_plots_legacy(time_series), number)
+    print(f'\tOpen figures afterwards: {len(plt.get_fignums())}')
+    plt.close('all')
+    benchmark('Downsampled 12-lead grid', lambda: plot_functions.render_ecg_grid(time_series), number)
+    print(f'\tOpen figures afterwards: {len(plt.get_fignums())}')
+
+
+def predict_legacy(session, tensions, threshold=0.20):
+    # predict before the tensions were sent as base64, the comma separated string is parsed into a dataframe
+    tensions = list(map(int, tensions.split(',')))
+    tensions = pd.DataFrame([tensions], columns=[i for i in range(0, 60000)]).iloc[:1].to_numpy()
+
+    model_path = model_functions.get_model_path()
+    model = model_functions.get_model(model_path)
+    predictions = model_functions.run_model(model, model_functions.get_model_input(model, tensions))
+    df = model_functions.get_diagnoses(predictions, model_functions.get_labels(session, model_path), threshold)
+    return df.drop(columns='ROW').to_json()
+
+
+def predict_with_patient_id_legacy(session, patient_id, threshold=0.20):
+    # predict_with_patient_id before the tensions were sent as base64, LISTAGG builds the string on the server
+    if config.lead_layout == 'wide':
+        tensions = session.sql(f'SELECT w.tensions FROM {config.dim_lead_wide} w '
+                               f'WHERE w.patient_id = \'{patient_id}\'').collect()[0][0]
+        tensions = ','.join(map(str, np.frombuffer(tensions, dtype='<i2').tolist()))
+    else:
+        tensions = session.sql(f'SELECT LISTAGG(l.tension, \',\') WITHIN GROUP (ORDER BY l.timestamp) AS tensions '
+                               f'FROM {config.dim_lead} l '
+                               f'WHERE l.patient_id = \'{patient_id}\'').collect()[0][0]
+    return session.sql(f'CALL predict_legacy(\'{tensions}\', {threshold})').collect()[0][0]
+
+
+def predict_with_patient_id_client_encoding(session, patient_id, threshold=0.20):
+    # The long layout pulled as 60000 rows and encoded as base64 on the client
+    df = session.sql(f'SELECT l.tension FROM {config.dim_lead} l '
+                     f'WHERE l.patient_id = \'{patient_id}\' ORDER BY l.timestamp').to_pandas()
+    tensions = model_functions.encode_tensions_base64(df['TENSION'].to_numpy())
+    return session.sql(f'CALL predict(\'{tensions}\', {threshold})').collect()[0][0]
+
+
+def create_predict_session(directory, time_series):
+    # Local database with one patient in both lead layouts, a staged untrained model with its labels and the
+    # predict procedures, like after setup and train_model
+    session = LocalSession(':memory:', directory)
+    snowflake_functions.create_stage(session, config.models_stage)
+    snowflake_functions.create_stage(session, config.functions_stage)
+    for module in ['model_functions.py', 'bulk_functions.py', 'signal_functions.py', 'config.py']:
+        session.file.put(os.path.join(os.path.dirname(os.path.abspath(__file__)), module),
+                         f'@{config.functions_stage}', auto_compress=False, overwrite=True)
+    model_file = os.path.join(directory, 'my_model.h5')
+    model_functions.create_model(signal_functions.get_num_features(), 20, 'dense').save(model_file)
+    session.file.put(model_file, f'@{config.models_stage}', auto_compress=False, overwrite=True)
+
+    snowflake_functions.create_dim_disease_info_table(session)
+    session.sql(f'CREATE OR REPLACE TABLE {config.table_model_labels} ('
+                f'label_id NUMBER(2, 0), '
+                f'disease_info_id NUMBER(9, 0))').collect()
+    bulk_functions.insert_rows(session, config.dim_disease_info, ['acronym', 'full_name', 'disease_info_id'],
+                               [[f'D{i}', f'Disease {i}', 100000 + i] for i in range(20)])
+    bulk_functions.insert_rows(session, config.table_model_labels, ['label_id', 'disease_info_id'],
+                               [[i, 100000 + i] for i in range(20)])
+
+    snowflake_functions.create_dim_lead_table(session)
+    session.write_pandas(df=local_functions.convert_mat_to_df(time_series, 'BENCH01'), table_name=config.dim_lead)
+    snowflake_functions.create_dim_lead_wide_table(session)
+    session.sql(f'INSERT INTO {config.dim_lead_wide} VALUES (\'BENCH01\', '
+                f'TO_BINARY(\'{model_functions.encode_tensions_base64(time_series.ravel())}\', \'BASE64\'))').collect()
+
+    for module, function in [('model_functions', 'predict'), ('benchmark_functions', 'predict_legacy')]:
+        snowflake_functions.create_stored_procedure_predict(session, module, function, 'STRING',
+                                                            ['tensions', 'threshold'], ['STRING', 'FLOAT'])
+    return session
+
+
+def benchmark_predict_with_patient_id(number=10):
+    # One diagnosis end to end: the tensions query, the CALL predict literal and the procedure with the model.
+    # In the long layout the query that pulls the 60000 rows to the client is slower than the LISTAGG row.
+    time_series = get_random_time_series()
+    lead_layout = config.lead_layout
+    with tempfile.TemporaryDirectory() as directory:
+        session = create_predict_session(directory, time_series)
+        try:
+            for layout in ['long', 'wide']:
+                config.lead_layout = layout
+
+                def legacy():
+                    return predict_with_patient_id_legacy(session, 'BENCH01', 0.0)
+
+                def base64_int16():
+                    return model_functions.predict_with_patient_id(session, 'BENCH01', 0.0)
+
+                if not np.allclose(pd.read_json(legacy())['CONFIDENCE'].to_numpy(),
+                                   base64_int16()['Confidence'].to_numpy().astype(float)):
+                    raise ValueError('The base64 transport does not return the same diagnoses')
+
+                print(f'Diagnosing one patient with predict_with_patient_id ({layout} layout):')
+                legacy_seconds = benchmark('Comma separated string', legacy, number)
+                if layout == 'long':
+                    benchmark('Client pull of 60000 rows and base64 int16',
+                              lambda: predict_with_patient_id_client_encoding(session, 'BENCH01', 0.0), number)
+                    benchmark('Query of the 60000 rows alone',
+                              lambda: session.sql(f'SELECT l.tension FROM {config.dim_lead} l '
+                                                  f'WHERE l.patient_id = \'BENCH01\' ORDER BY l.timestamp').to_pandas(),
+                              number)
+                    benchmark('Query of the LISTAGG row alone',
+                              lambda: session.sql(f'SELECT LISTAGG(l.tension, \',\') WITHIN GROUP '
+                                                  f'(ORDER BY l.timestamp) FROM {config.dim_lead} l '
+                                                  f'WHERE l.patient_id = \'BENCH01\'').collect(), number)
+                base64_seconds = benchmark('LISTAGG and base64 int16' if layout == 'long' else 'Base64 int16',
+                                           base64_int16, number)
+                print(f'\tSpeedup: {legacy_seconds / base64_seconds:.1f}x')
+        finally:
+            config.lead_layout = lead_layout
+            session.close()
+
+
+def get_random_headers(num_patients=45152, seed=0):
+    # Fake (patient_id, age, gender, dxs) headers with the size of the full database and ~55 distinct codes
+    rng = np.random.default_rng(seed)
+    codes = rng.integers(10000000, 999999999, size=55)
+    return [(f'JS{i + 1:05d}', int(rng.integers(0, 90)), 'MFX'[rng.integers(0, 3)],
+             sorted(set(rng.choice(codes, size=rng.integers(1, 5)).tolist()))) for i in range(num_patients)]
+
+
+def benchmark_patient_index(number=1000):
+    headers = get_random_headers()
+    index = header_functions.create_patient_index(headers)
+    dim_disease = pd.DataFrame([[header[0], dx] for header in headers for dx in header[3]],
+                               columns=['PATIENT_ID', 'DISEASE_INFO_ID'])
+    code = headers[0][3][0]
+
+    def dataframe_scan():
+        return dim_disease['PATIENT_ID'][dim_disease['DISEASE_INFO_ID'] == code].to_numpy()
+
+    def inverted_index():
+        return header_functions.get_patients_with_code(index, code)
+
+    if not np.array_equal(dataframe_scan().astype(str), inverted_index()):
+        raise ValueError('The index does not return the same patients as dim_disease')
+
+    print(f'Finding the patients with one SNOMED code ({len(headers)} patients):')
+    scan_seconds = benchmark('dim_disease dataframe scan', dataframe_scan, number // 10)
+    index_seconds = benchmark('Inverted index', inverted_index, number)
+    benchmark('Diagnoses of one patient', lambda: header_functions.get_patient_diagnoses(index, 'JS40000'), number)
+    print(f'\tSpeedup: {scan_seconds / index_seconds:.1f}x')
+
+
+def benchmark_ecg_store(num_records=256, number=200):
+    with tempfile.TemporaryDirectory() as directory:
+        # Fake .mat records and a store built from them
+        file_paths = []
+        for i in range(num_records):
+            file_paths.append(os.path.join(directory, f'JS{i + 1:05d}'))
+            sc.savemat(f'{file_paths[-1]}.mat', {'val': get_random_time_series(i)})
+        store_directory = os.path.join(directory, 'ecg_store')
+        store_functions.build_ecg_store(file_paths, directory=store_directory)
+        store = store_functions.load_ecg_store(store_directory)
+
+        def loadmat():
+            return sc.loadmat(f'{file_paths[100]}.mat')['val']
+
+        def memmap():
+            return store_functions.get_ecg(store, 'JS00101')
+
+        if not np.array_equal(loadmat(), memmap()):
+            raise ValueError('The store does not return the same tensions as the .mat file')
+
+        print('Reading the tensions of one record:')
+        loadmat_seconds = benchmark('scipy.io.loadmat', loadmat, number)
+        memmap_seconds = benchmark('Memory-mapped store', memmap, number)
+        print(f'\tSpeedup: {loadmat_seconds / memmap_seconds:.1f}x')
+
+        # The mapping has to be closed before the temporary directory can be removed on Windows
+        del store
+        store_functions.read_ecg_store.cache_clear()
+
+
+def benchmark_query_cache(number=200):
+    # The age and gender of one patient, as the Patient tab reads them on every rerun
+    with tempfile.TemporaryDirectory() as directory:
+        session = LocalSession(':memory:', directory)
+        snowflake_functions.create_fact_patient_table(session)
+        session.sql(f'INSERT INTO {config.fact_patient} VALUES (\'BENCH01\', 40, \'M\')').collect()
+
+        def query():
+            return snowflake_functions.get_age_and_gender.__wrapped__('BENCH01', session)
+
+        def cached():
+            return snowflake_functions.get_age_and_gender('BENCH01', session)
+
+        if not query().equals(cached()):
+            raise ValueError('The cached result is not identical to the query result')
+
+        print('Reading the age and gender of one patient:')
+        query_seconds = benchmark('Query', query, number)
+        cached_seconds = benchmark('Query cache', cached, number)
+        print(f'\tSpeedup: {query_seconds / cached_seconds:.1f}x, hit rate {query_cache.get_stats()["hit_rate"]:.3f}')
+        query_cache.clear()
+        session.close()
+
+
+def benchmark_preprocessing(batch_size=32, number=5):
+    # Model input and prediction latency of a batch with the raw tensions and with the preprocessed tensions
+    tensions = np.stack([get_random_time_series(seed).ravel() for seed in range(batch_size)]).astype(np.float32)
+    raw_model = model_functions.create_model(model_functions.NUM_TENSIONS, 20, 'dense')
+    model = model_functions.create_model(signal_functions.get_num_features(), 20, 'dense')
+
+    print(f'Preprocessing and predicting a batch of {batch_size} ECGs:')
+    print(f'\tInputs: {model_functions.NUM_TENSIONS} raw, {signal_functions.get_num_features()} preprocessed')
+    print(f'\tWeights: {raw_model.count_params()} raw, {model.count_params()} preprocessed')
+    inputs = signal_functions.preprocess_tensions(tensions)
+    benchmark('Preprocessing', lambda: signal_functions.preprocess_tensions(tensions), number)
+    benchmark('Model on raw tensions', lambda: raw_model(tensions, training=False), number)
+    benchmark('Model on preprocessed tensions', lambda: model(inputs, training=False), number)
+
+
+def benchmark_model_architectures(batch_size=32, number=5):
+    # Weights, size of my_model.h5 and prediction latency of every architecture of train_model
+    inputs = signal_functions.preprocess_tensions(
+        np.stack([get_random_time_series(seed).ravel() for seed in range(batch_size)]))
+
+    print('Model architectures:')
+    for architecture in ['dense', 'cnn']:
+        model = model_functions.create_model(signal_functions.get_num_features(), 20, architecture)
+        with tempfile.TemporaryDirectory() as directory:
+            model_file = os.path.join(directory, 'my_model.h5')
+            model.save(model_file, include_optimizer=False)
+            file_size = os.path.getsize(model_file)
+            load_seconds = min(timeit.repeat(lambda: model_functions.load_model(model_file, compile=False),
+                                             number=1, repeat=3))
+
+        print(f'\t{architecture}: {model.count_params()} weights, '
+              f'{model_functions.count_multiply_adds(model)} multiply-adds per ECG, {file_size / 1024:.1f} KB, '
+              f'loaded in {load_seconds * 1000:.2f} ms')
+        benchmark(f'{architecture} model on one ECG', lambda: model(inputs[:1], training=False), number)
+        benchmark(f'{architecture} model on a batch of {batch_size} ECGs', lambda: model(inputs, training=False),
+                  number)
+
+
+if __name__ == "__main__":
+    benchmark_write_mat_file_to_csv()
+    benchmark_get_tensions()
+    benchmark_convert_mat_to_df()
+    benchmark_ecg_plot()
+    benchmark_predict_with_patient_id()
+    benchmark_patient_index()
+    benchmark_ecg_store()
+    benchmark_query_cache()
+    benchmark_preprocessing()
+    benchmark_model_architectures()
@@ -0,0 +1,61 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+import numpy as np
+
+import config
+
+# Snowflake accepts at most 16384 rows in the VALUES clause of one INSERT
+MAX_ROWS_PER_INSERT = 16384
+
+# Round trips to the warehouse per table of the bulk writes, and the rows they wrote
+round_trips = {}
+rows_written = {}
+
+
+def insert_rows(session, table, columns, rows, batch_size=MAX_ROWS_PER_INSERT):
+    # Write rows to a table with one multi-row INSERT per batch_size rows instead of one INSERT per row.
+    # Returns the number of round trips.
+    rows = list(rows)
+    num_round_trips = 0
+    for i in range(0, len(rows), batch_size):
+        values = ', '.join(f'({", ".join(format_value(value) for value in row)})' for row in rows[i:i + batch_size])
+        session.sql(f'INSERT INTO {table} ({", ".join(columns)}) VALUES {values}').collect()
+        num_round_trips += 1
+
+    round_trips[table] = round_trips.get(table, 0) + num_round_trips
+    rows_written[table] = rows_written.get(table, 0) + len(rows)
+    return num_round_trips
+
+
+def format_value(value):
+    # SQL literal of a Python or NumPy value
+    if value is None:
+        return 'NULL'
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, Decimal)):
+        return str(value)
+    if isinstance(value, float):
+        if np.isnan(value):
+            return 'NULL'
+        if np.isinf(value):
+            return f'CAST(\'{"-" if value < 0 else ""}inf\' AS FLOAT)'
+        return repr(value)
+    if isinstance(value, (date, datetime)):
+        value = value.isoformat()
+    return format_string(str(value))
+
+
+def format_string(value):
+    # Snowflake reads a backslash in a string literal as an escape, DuckDB stores it as it is
+    if config.backend != 'local':
+        value = value.replace('\\', '\\\\')
+    return '\'' + value.replace('\'', '\'\'') + '\''
+
+
+def get_round_trips():
+    # Round trips and written rows per table since the start of the process
+    return {table: {'round_trips': round_trips[table], 'rows': rows_written[table]} for table in round_trips}
@@ -1,3 +1,25 @@
+# Backend the sessions are created on: 'snowflake' or 'local' (embedded DuckDB database with local stages)
+backend = 'snowflake'
+local_database = 'local_warehouse/arrhythmia_study.duckdb'
+local_stage_directory = 'local_warehouse/stages'
+
+# Sessions the Streamlit app shares: at most session_pool_size open at once, a session that was idle for
+# session_idle_timeout seconds is closed and one idle for session_health_check_interval seconds is checked first
+session_pool_size = 4
+session_idle_timeout = 600
+session_health_check_interval = 60
+
+# Results of the read functions of snowflake_functions are cached for query_cache_ttl seconds,
+# in at most query_cache_max_bytes of memory
+query_cache_ttl = 300
+query_cache_max_bytes = 64 * 1024 * 1024
+
+# Diagnoses of the app run on diagnosis_workers background threads, the last diagnosis_cache_size results are kept.
+# The version of the staged model is looked up again after model_version_ttl seconds
+diagnosis_workers = 2
+diagnosis_cache_size = 256
+model_version_ttl = 60
+
 warehouse = 'ARRHYTHMIA_STUDY'
 warehouse_optimized = 'ARRHYTHMIA_STUDY_OPTIMIZED'
 database = 'ARRHYTHMIA_STUDY'
@@ -15,16 +37,50 @@ role = 'SYSADMIN'
 
 csv_stage = 'STAGE_CSV'
 csv_stage_lead = 'STAGE_CSV_LEAD'
+parquet_stage_lead = 'STAGE_PARQUET_LEAD'
+csv_stage_lead_wide = 'STAGE_CSV_LEAD_WIDE'
 functions_stage = 'STAGE_FUNCTIONS'
 models_stage = 'STAGE_MODELS'
 
+# Sequence the patient_ids of uploaded ECGs are taken from
+patient_id_sequence = 'PATIENT_ID_SEQUENCE'
+
 csv_format = 'FORMAT_CSV'
+parquet_format = 'FORMAT_PARQUET'
 
 fact_patient = 'FACT_PATIENT'
 dim_disease = 'DIM_DISEASE'
 dim_disease_info = 'DIM_DISEASE_INFO'
 dim_lead = 'DIM_LEAD'
+dim_lead_wide = 'DIM_LEAD_WIDE'
+dim_lead_staging = 'DIM_LEAD_STAGING'
 table_user = 'USER'
 table_patient_user = 'PATIENT_USER'
 table_tensions_diseases = 'TENSION_DISEASE'
 table_model_labels = 'MODEL_LABEL'
+table_training_split = 'TRAINING_SPLIT'
+
+# Physical layout of the lead tables: a clustering key keeps the rows of a patient together in a few
+# micro-partitions, search optimization (Enterprise Edition) adds a lookup structure for patient_id filters.
+# With an ordered load the lead files are copied into dim_lead_staging and inserted in patient order.
+dim_lead_clustering = True
+dim_lead_search_optimization = False
+dim_lead_ordered_load = True
+
+# Preprocessing of the tensions ahead of the model: a Butterworth band-pass filter from signal_low_cut to
+# signal_high_cut Hz, every signal_decimation-th sample of the filtered leads, then standardization per lead.
+# The filter order has to be high enough to suppress what would alias after the decimation.
+signal_sample_rate = 500
+signal_low_cut = 0.5
+signal_high_cut = 40.0
+signal_filter_order = 4
+signal_decimation = 4
+
+# Architecture of the model train_model trains: 'dense' (fully connected layers over all preprocessed tensions)
+# or 'cnn' (strided 1D convolutions along the time axis of every lead and global average pooling). The cnn model
+# has far fewer weights and multiply-adds, switching to it changes the model every deployment trains.
+model_architecture = 'dense'
+
+# Layout the tensions are read from: 'long' (DIM_LEAD, one row per sample)
+# or 'wide' (DIM_LEAD_WIDE, one row per patient with the 12x5000 tensions as int16 bytes)
+lead_layout = 'long'
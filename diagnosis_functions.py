@@ -0,0 +1,43 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import model_functions
+import snowflake_functions
+
+# Background diagnoses of the app: (patient_id, model version, threshold) -> Future of the diagnoses DataFrame.
+# A diagnosis is computed once per patient and model, every rerun of the app after that reuses the result.
+executor = ThreadPoolExecutor(max_workers=config.diagnosis_workers, thread_name_prefix='diagnosis')
+diagnoses = OrderedDict()
+diagnoses_lock = threading.Lock()
+
+
+def submit_diagnosis(pool, patient_id, threshold=0.20):
+    # Start the diagnosis of a patient in the background, or return the job that already runs or ran for the
+    # patient with the current model. A job that failed is started again.
+    with pool.session() as session:
+        model_version = snowflake_functions.get_model_version(session)
+    key = (patient_id, model_version, threshold)
+
+    with diagnoses_lock:
+        future = diagnoses.get(key)
+        if future is None or (future.done() and future.exception() is not None):
+            future = executor.submit(diagnose, pool, patient_id, threshold)
+            diagnoses[key] = future
+            forget_finished_diagnoses()
+        diagnoses.move_to_end(key)
+        return future
+
+
+def diagnose(pool, patient_id, threshold):
+    with pool.session() as session:
+        return model_functions.predict_with_patient_id(session, patient_id, threshold)
+
+
+def forget_finished_diagnoses():
+    # Drop the least recently used finished diagnoses above diagnosis_cache_size, called with the lock held
+    for key in [key for key, future in diagnoses.items() if future.done()]:
+        if len(diagnoses) <= config.diagnosis_cache_size:
+            break
+        del diagnoses[key]
@@ -0,0 +1,127 @@
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+# Location of the patient/diagnosis index that is built from the .hea files
+PATIENT_INDEX_PATH = 'csv_files/patient_index.npz'
+
+# Gender codes of the index, -1 is a header without a #Sex line
+GENDERS = np.array(['M', 'F', 'X'])
+
+
+def parse_hea_files(file_paths, processes=1, parse_file=None):
+    # Parse the headers of many records, in order, with a pool of processes
+    parse_file = parse_file or parse_hea_file
+    if processes > 1:
+        with Pool(processes) as pool:
+            return list(pool.imap(parse_file, file_paths, chunksize=256))
+    return [parse_file(file_path) for file_path in file_paths]
+
+
+def parse_hea_file(file_path):
+    # Returns (patient_id, age, gender, dxs) of a record, age and gender are None when unknown
+    with open(file_path + '.hea', 'rb') as hea_file:
+        return parse_hea_content(os.path.basename(file_path), hea_file.read())
+
+
+def parse_hea_content(patient_id, content):
+    age, gender, dxs = None, None, []
+
+    # Only the comment lines of a header hold patient information
+    for line in content.decode('ascii', errors='replace').splitlines():
+        if not line.startswith('#'):
+            continue
+        key, _, value = line.partition(' ')
+        value = value.rstrip()
+        # Collecting the age
+        if key == '#Age:':
+            age = None if value == 'NaN' else int(value)
+        # Collecting the gender
+        elif key == '#Sex:':
+            gender = 'M' if value == 'Male' else 'F' if value == 'Female' else 'X'
+        # Collecting the diseases
+        elif key == '#Dx:':
+            dxs = [int(x) for x in value.split(',') if 9999999 < int(x) < 1000000000]
+
+    return patient_id, age, gender, dxs
+
+
+def create_patient_index(headers):
+    # Columnar index of (patient_id, age, gender, dxs) headers. The diagnoses of patient i are
+    # dx_codes[dx_offsets[i]:dx_offsets[i + 1]] and the patients with code_values[j] are
+    # code_patients[code_offsets[j]:code_offsets[j + 1]]
+    patient_ids = np.array([header[0] for header in headers], dtype='U7')
+    ages = np.array([-1 if header[1] is None else header[1] for header in headers], dtype=np.int8)
+    genders = np.array([-1 if header[2] is None else 'MFX'.index(header[2]) for header in headers], dtype=np.int8)
+    dx_counts = np.array([len(header[3]) for header in headers], dtype=np.int64)
+    dx_offsets = np.concatenate([[0], np.cumsum(dx_counts)])
+    dx_codes = np.array([dx for header in headers for dx in header[3]], dtype=np.int32)
+
+    # Inverted index from diagnosis code to patients, built by sorting the (code, patient) pairs
+    dx_patients = np.repeat(np.arange(len(headers), dtype=np.int32), dx_counts)
+    order = np.lexsort((dx_patients, dx_codes))
+    code_values, code_counts = np.unique(dx_codes[order], return_counts=True)
+
+    return {
+        'patient_ids': patient_ids,
+        'patient_order': np.argsort(patient_ids).astype(np.int32),
+        'ages': ages,
+        'genders': genders,
+        'dx_offsets': dx_offsets,
+        'dx_codes': dx_codes,
+        'code_values': code_values.astype(np.int32),
+        'code_offsets': np.concatenate([[0], np.cumsum(code_counts)]),
+        'code_patients': dx_patients[order]
+    }
+
+
+def save_patient_index(index, path=PATIENT_INDEX_PATH):
+    # Uncompressed, so loading the index is a plain read of its arrays
+    np.savez(f'{path}.tmp.npz', **index)
+    os.replace(f'{path}.tmp.npz', path)
+
+
+def load_patient_index(path=PATIENT_INDEX_PATH):
+    with np.load(path, allow_pickle=False) as arrays:
+        return {key: arrays[key] for key in arrays.files}
+
+
+def get_patients_with_code(index, code):
+    # All patient_ids with SNOMED code `code`, found with a binary search in the inverted index
+    i = np.searchsorted(index['code_values'], code)
+    if i == len(index['code_values']) or index['code_values'][i] != code:
+        return index['patient_ids'][:0]
+    return index['patient_ids'][index['code_patients'][index['code_offsets'][i]:index['code_offsets'][i + 1]]]
+
+
+def get_patient_position(index, patient_id):
+    # Position of a patient in the index, or None
+    i = np.searchsorted(index['patient_ids'], patient_id, sorter=index['patient_order'])
+    if i == len(index['patient_ids']) or index['patient_ids'][index['patient_order'][i]] != patient_id:
+        return None
+    return int(index['patient_order'][i])
+
+
+def get_patient_diagnoses(index, patient_id):
+    i = get_patient_position(index, patient_id)
+    if i is None:
+        return index['dx_codes'][:0]
+    return index['dx_codes'][index['dx_offsets'][i]:index['dx_offsets'][i + 1]]
+
+
+def get_headers(index):
+    # The (patient_id, age, gender, dxs) headers of an index, in index order
+    return [get_header(index, i) for i in range(len(index['patient_ids']))]
+
+
+def get_header(index, i):
+    age, gender = int(index['ages'][i]), int(index['genders'][i])
+    return (str(index['patient_ids'][i]), None if age < 0 else age, None if gender < 0 else str(GENDERS[gender]),
+            index['dx_codes'][index['dx_offsets'][i]:index['dx_offsets'][i + 1]].tolist())
+
+
+def get_patient_rows(index, i):
+    # The fact_patient row and dim_disease rows of patient i
+    patient_id, age, gender, dxs = get_header(index, i)
+    return [patient_id, age, gender], [[patient_id, dx] for dx in dxs]
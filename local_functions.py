@@ -1,23 +1,65 @@
 import csv
 import os
+from datetime import datetime
+from multiprocessing import Pool
 from pathlib import Path
 
+import numpy as np
 import scipy.io as sc
 import pandas as pd
 from tqdm import tqdm
+import base64
 import contextlib
+import hashlib
+import io
+from functools import lru_cache, partial
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import header_functions
+import store_functions
 
 # URL to locate package concerning all the files around our project
 # This package has to be on the same level as the project directory
 BASE_PATH = '.\\..\\a-large-scale-12-lead-electrocardiogram-database-for-arrhythmia-study-1.0.0\\'
 
+# Number of dim_lead_*.csv files the tensions are spread over
+NUM_DIM_LEAD_FILES = 256
+
+# Number of rows in one row group of a dim_lead_*.parquet file (20 records)
+PARQUET_ROW_GROUP_SIZE = 20 * 60000
+
+DIM_LEAD_PARQUET_SCHEMA = pa.schema([
+    ('PATIENT_ID', pa.dictionary(pa.int32(), pa.string())),
+    ('TIMESTAMP', pa.int32()),
+    ('TENSION', pa.int16())
+])
+
+# Directory with a manifest for every converted file, e.g. manifest/csv_files/dim_lead/dim_lead_001.csv
+# A manifest lists the records in the order they were written, their size, mtime and md5 and the end offset
+# of every output file after the record was written. Only the records in a manifest are committed.
+MANIFEST_DIRECTORY = 'manifest/'
+MANIFEST_HEADER = ['RECORD', 'SIZE', 'MTIME', 'MD5', 'OFFSETS']
+
+PATIENT_CSV_FILES = ['csv_files/fact_patient.csv', 'csv_files/dim_disease.csv']
 
-def convert_files_locally(mat_files, hea_files):
+
+def convert_files_locally(mat_files, hea_files, processes=1, format='csv', row_group_size=PARQUET_ROW_GROUP_SIZE,
+                          ecg_store=False):
     all_file_paths = get_all_file_paths()
+    if ecg_store:
+        # Memory-mapped int16 array with the tensions of all records for local training, plotting and prediction
+        store_functions.build_ecg_store(all_file_paths, processes)
     if hea_files:
-        convert_all_hea_files_to_csv(all_file_paths)
+        convert_all_hea_files_to_csv(all_file_paths, processes)
     if mat_files:
-        convert_all_mat_files_to_csv(all_file_paths)
+        if format == 'parquet':
+            convert_all_mat_files_to_parquet(all_file_paths, processes, row_group_size)
+        elif format == 'wide':
+            convert_all_mat_files_to_wide_csv(all_file_paths, processes)
+        else:
+            convert_all_mat_files_to_csv(all_file_paths, processes)
 
 
 # Reading the record file and getting all the different filenames (without extension)
@@ -31,105 +73,424 @@ def get_all_file_paths():
     return paths
 
 
-def convert_all_hea_files_to_csv(all_file_paths):
+def convert_all_hea_files_to_csv(all_file_paths, processes=1):
     # Create directory to save the csv-files
     os.makedirs('csv_files/', exist_ok=True)
 
-    # Create fact_patient.csv and dim_disease.csv files
-    with contextlib.ExitStack() as stack:
-        csv_files = [stack.enter_context(open(f'csv_files/{filename}.csv', 'w', newline=''))
-                     for filename in ['fact_patient', 'dim_disease']]
-        csv_writers = [csv.writer(csv_file) for csv_file in csv_files]
-        csv_writers[0].writerow(['PATIENT_ID', 'AGE', 'GENDER'])
-        csv_writers[1].writerow(['PATIENT_ID', 'DISEASE_INFO_ID'])
+    # fact_patient.csv and dim_disease.csv are one shard with a single manifest
+    shards = plan_shards(all_file_paths, [PATIENT_CSV_FILES], '.hea')
+    print_plan(len(all_file_paths), shards, '.hea')
+
+    indexes = []
+    for _, file_paths, append in shards:
+        # Parse the headers in parallel, the csv-files are written from the resulting index
+        results = header_functions.parse_hea_files(file_paths, processes, parse_hea_record)
+        index = header_functions.create_patient_index([header for header, _ in results])
+        indexes.append(index)
 
-        # Loop over all file paths
-        for i in tqdm(range(len(all_file_paths)), desc='Converting .hea files to csv...'):
-            write_hea_file_to_csv(all_file_paths[i], csv_writers[0], csv_writers[1])
+        headers = [['PATIENT_ID', 'AGE', 'GENDER'], ['PATIENT_ID', 'DISEASE_INFO_ID']]
+        with open_shard(PATIENT_CSV_FILES, headers, append) as (csv_files, commit_record):
+            csv_writers = [csv.writer(csv_file) for csv_file in csv_files]
+
+            # Loop over all records
+            for i in tqdm(range(len(file_paths)), desc='Converting .hea files to csv...'):
+                patient_row, disease_rows = header_functions.get_patient_rows(index, i)
+                csv_writers[1].writerows(disease_rows)
+                csv_writers[0].writerow(patient_row)
+                commit_record(file_paths[i], results[i][1])
 
     # csv files are automatically closed when the with-block is exited
 
+    update_patient_index(indexes, processes)
+
 
-def write_hea_file_to_csv(file_path, patient_writer, disease_writer):
-    # Load .hea file
-    with open(file_path + '.hea', 'r') as hea_file:
-        # Declaration
-        age, sex, gender, dxs = None, None, None, []
+def parse_hea_record(file_path):
+    # The header of a record and its fingerprint for the manifest, from one read of the .hea file
+    with open(file_path + '.hea', 'rb') as hea_file:
+        content = hea_file.read()
+    header = header_functions.parse_hea_content(os.path.basename(file_path), content)
+    return header, get_fingerprint(file_path + '.hea', content)
 
-        # Looping all the lines
-        for line in hea_file:
-            # Collecting the age
-            if line.startswith('#Age:'):
-                age = line.split(' ', 1)[1].rstrip()
-                if age == 'NaN':
-                    age = None
-            # Collecting the gender
-            elif line.startswith('#Sex:'):
-                sex = line.split(' ', 1)[1].rstrip()
-                gender = 'M' if sex == 'Male' else 'F' if sex == 'Female' else 'X'
-            # Collecting the diseases
-            elif line.startswith('#Dx:'):
-                dxs = [int(x) for x in line.split(' ', 1)[1].rstrip().split(',') if 9999999 < int(x) < 1000000000]
 
-    # Collecting the patient_id
-    patient_id = os.path.basename(file_path)
+def update_patient_index(indexes, processes=1):
+    # The saved index holds exactly the committed records of fact_patient.csv, in the same order.
+    # Headers come from the indexes just written or the saved index, only records missing from both are parsed.
+    file_paths = [entry[0] for entry in read_manifest(PATIENT_CSV_FILES[0]) or []]
+    if os.path.exists(header_functions.PATIENT_INDEX_PATH):
+        indexes = [header_functions.load_patient_index()] + indexes
 
-    # Writing each disease to the csv-file dim_disease.csv
-    disease_writer.writerows([[patient_id, disease] for disease in dxs])
+    headers = {}
+    for index in indexes:
+        headers.update((header[0], header) for header in header_functions.get_headers(index))
+    missing = [file_path for file_path in file_paths if os.path.basename(file_path) not in headers]
+    headers.update((header[0], header) for header in header_functions.parse_hea_files(missing, processes))
 
-    # Writing the patient info to the csv-file fact_patient.csv
-    patient_writer.writerow([patient_id, age, gender])
+    index = header_functions.create_patient_index([headers[os.path.basename(file_path)] for file_path in file_paths])
+    header_functions.save_patient_index(index)
 
 
-def convert_all_mat_files_to_csv(all_file_paths):
+def convert_all_mat_files_to_csv(all_file_paths, processes=1):
     # Create directory to save the csv-files
     Path('csv_files/dim_lead/').mkdir(parents=True, exist_ok=True)
 
-    # Create 256 dim_lead_*.csv files and csv writers to those files
-    num_files = 256
-    csv_writers = []
-    csv_files = []
-    for i in range(num_files):
-        file_path = f'csv_files/dim_lead/dim_lead_{i + 1:03d}.csv'
-        csv_file = open(file_path, 'w', newline='')
+    start_time = datetime.now()
+
+    # Only the dim_lead_*.csv files with new, changed or removed records are written
+    shards = plan_shards(all_file_paths, [[get_dim_lead_file_path(i)] for i in range(NUM_DIM_LEAD_FILES)], '.mat')
+    print_plan(len(all_file_paths), shards, '.mat')
+    convert_shards(write_mat_files_to_csv, shards, processes, 'csv')
+
+    print_throughput(sum(len(file_paths) for _, file_paths, _ in shards), start_time)
+
+
+def convert_all_mat_files_to_parquet(all_file_paths, processes=1, row_group_size=PARQUET_ROW_GROUP_SIZE):
+    # Create directory to save the parquet-files
+    Path('parquet_files/dim_lead/').mkdir(parents=True, exist_ok=True)
+
+    start_time = datetime.now()
+
+    # A parquet file can not be appended to, so every dim_lead_*.parquet file with work is rewritten
+    shards = plan_shards(all_file_paths, [[get_dim_lead_parquet_file_path(i)] for i in range(NUM_DIM_LEAD_FILES)],
+                         '.mat', appendable=False)
+    print_plan(len(all_file_paths), shards, '.mat')
+    write_shard = partial(write_mat_files_to_parquet, row_group_size=row_group_size)
+    convert_shards(write_shard, shards, processes, 'parquet')
+
+    print_throughput(sum(len(file_paths) for _, file_paths, _ in shards), start_time)
+
+
+def convert_all_mat_files_to_wide_csv(all_file_paths, processes=1):
+    # Create directory to save the csv-files with one row per record
+    Path('csv_files/dim_lead_wide/').mkdir(parents=True, exist_ok=True)
+
+    start_time = datetime.now()
+
+    shards = plan_shards(all_file_paths, [[get_dim_lead_wide_file_path(i)] for i in range(NUM_DIM_LEAD_FILES)],
+                         '.mat')
+    print_plan(len(all_file_paths), shards, '.mat')
+    convert_shards(write_mat_files_to_wide_csv, shards, processes, 'wide csv')
+
+    print_throughput(sum(len(file_paths) for _, file_paths, _ in shards), start_time)
+
+
+def convert_shards(write_shard, shards, processes, file_type):
+    # Every shard is owned by exactly one worker
+    if processes > 1:
+        with Pool(processes) as pool:
+            for _ in tqdm(pool.imap_unordered(write_shard, shards), total=len(shards),
+                          desc=f'Converting .mat files to {file_type} with {processes} processes...'):
+                pass
+    else:
+        for shard in tqdm(shards, desc=f'Converting .mat files to {file_type}...'):
+            write_shard(shard)
+
+
+def plan_shards(all_file_paths, shard_output_paths, extension, appendable=True):
+    # Compare every shard with its manifest and return (index, file_paths, append) for the shards with work.
+    # Known records stay in the shard they were written to, new records go to shard i % number of shards.
+    manifests = [read_committed_manifest(output_paths, appendable) for output_paths in shard_output_paths]
+    known_records = {entry[0] for manifest in manifests if manifest for entry in manifest}
+    new_records = [[] for _ in shard_output_paths]
+    for i, file_path in enumerate(all_file_paths):
+        if file_path not in known_records:
+            new_records[i % len(shard_output_paths)].append(file_path)
+
+    all_records = set(all_file_paths)
+    shards = []
+    for index, (output_paths, manifest) in enumerate(zip(shard_output_paths, manifests)):
+        if not manifest:
+            # Nothing committed yet, so the shard is written from scratch
+            shards.append((index, new_records[index], False))
+            continue
+
+        stats = [entry[1:3] for entry in manifest]
+        kept = [entry for entry in manifest if entry[0] in all_records]
+        changed = [entry for entry in kept if is_record_changed(entry, extension)]
+        if changed or len(kept) < len(manifest) or (new_records[index] and not appendable):
+            # Rows can not be removed from a shard, so it is rewritten with all its current records
+            shards.append((index, [entry[0] for entry in kept] + new_records[index], False))
+            continue
+
+        # Store the new mtimes of records that were touched without changing their content
+        if [entry[1:3] for entry in manifest] != stats:
+            write_manifest(output_paths[0], manifest)
+        if new_records[index]:
+            shards.append((index, new_records[index], True))
+    return shards
+
+
+def read_committed_manifest(output_paths, appendable=True):
+    # Read the manifest of a shard and cut every output file back to the end of its last committed record.
+    # Returns None when the output files do not match the manifest and the shard has to be rewritten.
+    manifest = read_manifest(output_paths[0])
+    if not manifest:
+        return None
+
+    for output_path, offset in zip(output_paths, manifest[-1][4]):
+        size = os.path.getsize(output_path) if os.path.exists(output_path) else -1
+        if size < offset or (size > offset and not appendable):
+            return None
+        if size > offset:
+            # Remove the rows of a record that was being written when the conversion stopped
+            os.truncate(output_path, offset)
+    return manifest
+
+
+def read_manifest(output_path):
+    # Returns the [record, size, mtime, md5, offsets] entries of the manifest of a file, or None without a manifest
+    manifest_path = get_manifest_path(output_path)
+    if not os.path.exists(manifest_path):
+        return None
+
+    manifest = []
+    with open(manifest_path, 'r', newline='') as manifest_file:
+        reader = csv.reader(manifest_file)
+        next(reader, None)
+        for row in reader:
+            # A crash while appending a record can leave a partial last line
+            try:
+                record, size, mtime, md5, offsets = row
+                manifest.append([record, int(size), int(mtime), md5, [int(offset) for offset in offsets.split()]])
+            except ValueError:
+                break
+    return manifest
+
+
+def write_manifest(output_path, manifest):
+    replace_csv_file(get_manifest_path(output_path), MANIFEST_HEADER,
+                     [entry[:4] + [' '.join(map(str, entry[4]))] for entry in manifest])
+
+
+def replace_csv_file(path, header, rows):
+    # Replace the file in one step, so a crash never leaves half a file behind
+    with open(f'{path}.tmp', 'w', newline='') as csv_file:
         csv_writer = csv.writer(csv_file)
-        csv_writer.writerow(['PATIENT_ID', 'TIMESTAMP', 'TENSION'])
-        csv_files.append(csv_file)
-        csv_writers.append(csv_writer)
+        csv_writer.writerow(header)
+        csv_writer.writerows(rows)
+    os.replace(f'{path}.tmp', path)
+
 
-    # Loop over all file paths and write all tensions to a csv-file dim_lead_*.csv
-    for i in tqdm(range(len(all_file_paths)), f'Converting .mat files to csv...'):
-        file_path = all_file_paths[i]
-        writer_index = i % num_files
-        write_mat_file_to_csv(file_path, csv_writers[writer_index])
+def is_record_changed(entry, extension):
+    # Only hash a record again when its size or mtime is different from the manifest
+    record, size, mtime, md5, _ = entry
+    if not os.path.exists(record + extension):
+        return True
+    stat = os.stat(record + extension)
+    if (stat.st_size, stat.st_mtime_ns) == (size, mtime):
+        return False
+    fingerprint = get_fingerprint(record + extension)
+    if fingerprint[2] != md5:
+        return True
+    entry[1:3] = fingerprint[:2]
+    return False
 
-    # Close all csv files
-    for csv_file in csv_files:
-        csv_file.close()
 
+def get_fingerprint(path, content=None):
+    # Size, mtime and md5 of a record file as stored in the manifest
+    stat = os.stat(path)
+    if content is None:
+        with open(path, 'rb') as record_file:
+            content = record_file.read()
+    return [stat.st_size, stat.st_mtime_ns, hashlib.md5(content).hexdigest()]
 
-def write_mat_file_to_csv(file_path, writer):
-    # Load .mat file and convert to a dictionary
-    data_dict = sc.loadmat(f'{file_path}.mat')
+
+@contextlib.contextmanager
+def open_shard(output_paths, headers, append):
+    # Open the output files of a shard and its manifest. A rewrite starts the manifest over before the output
+    # files are truncated, an append continues after the last committed record.
+    mode = 'a' if append else 'w'
+    manifest_path = get_manifest_path(output_paths[0])
+    Path(manifest_path).parent.mkdir(parents=True, exist_ok=True)
+    with contextlib.ExitStack() as stack:
+        manifest_file = stack.enter_context(open(manifest_path, mode, newline=''))
+        manifest_writer = csv.writer(manifest_file)
+        output_files = [stack.enter_context(open(output_path, mode, newline='')) for output_path in output_paths]
+        if not append:
+            manifest_writer.writerow(MANIFEST_HEADER)
+            for output_file, header in zip(output_files, headers):
+                csv.writer(output_file).writerow(header)
+        yield output_files, partial(commit_record, manifest_file, manifest_writer, output_files)
+
+
+def commit_record(manifest_file, manifest_writer, output_files, file_path, fingerprint):
+    # A record only counts as converted once its rows are flushed and its manifest line is written
+    offsets = []
+    for output_file in output_files:
+        output_file.flush()
+        offsets.append(str(output_file.tell()))
+    manifest_writer.writerow([file_path] + fingerprint + [' '.join(offsets)])
+    manifest_file.flush()
+
+
+def get_manifest_path(output_path):
+    return os.path.join(MANIFEST_DIRECTORY, output_path)
+
+
+def print_plan(num_records, shards, extension):
+    num_converted = sum(len(file_paths) for _, file_paths, _ in shards)
+    print(f'{num_records - num_converted} of {num_records} {extension} records are already converted, '
+          f'converting {num_converted} records in {len(shards)} files')
+
+
+def get_dim_lead_file_path(index):
+    return f'csv_files/dim_lead/dim_lead_{index + 1:03d}.csv'
+
+
+def get_dim_lead_parquet_file_path(index):
+    return f'parquet_files/dim_lead/dim_lead_{index + 1:03d}.parquet'
+
+
+def get_dim_lead_wide_file_path(index):
+    return f'csv_files/dim_lead_wide/dim_lead_wide_{index + 1:03d}.csv'
+
+
+def write_mat_files_to_csv(shard):
+    # Write (or append) the records of one shard to its own dim_lead_*.csv file
+    index, file_paths, append = shard
+    with open_shard([get_dim_lead_file_path(index)], [['PATIENT_ID', 'TIMESTAMP', 'TENSION']],
+                    append) as (csv_files, commit_record):
+        for file_path in file_paths:
+            fingerprint = write_mat_file_to_csv(file_path, csv_files[0])
+            commit_record(file_path, fingerprint)
+    return len(file_paths)
+
+
+def write_mat_files_to_wide_csv(shard):
+    # Write every record of one shard as a single row with its 12x5000 tensions as base64 int16 bytes
+    index, file_paths, append = shard
+    with open_shard([get_dim_lead_wide_file_path(index)], [['PATIENT_ID', 'TENSIONS']],
+                    append) as (csv_files, commit_record):
+        csv_writer = csv.writer(csv_files[0])
+        for file_path in file_paths:
+            file_name, time_series, fingerprint = load_mat_file(file_path)
+            csv_writer.writerow([file_name, encode_tensions(time_series)])
+            commit_record(file_path, fingerprint)
+    return len(file_paths)
+
+
+def encode_tensions(time_series):
+    # Little-endian int16 bytes of the 12x5000 tensions, base64 encoded for TO_BINARY(..., 'BASE64')
+    tensions = np.asarray(time_series)[:12, :5000].astype('<i2')
+    return base64.b64encode(tensions.tobytes()).decode('ascii')
+
+
+def write_mat_files_to_parquet(shard, row_group_size=PARQUET_ROW_GROUP_SIZE):
+    # Write all records of one shard to its own dim_lead_*.parquet file in row groups of row_group_size rows
+    index, file_paths, _ = shard
+    output_path = get_dim_lead_parquet_file_path(index)
+
+    # The manifest is emptied first and only filled once the parquet file is complete
+    Path(get_manifest_path(output_path)).parent.mkdir(parents=True, exist_ok=True)
+    write_manifest(output_path, [])
+
+    manifest = []
+    with pq.ParquetWriter(output_path, DIM_LEAD_PARQUET_SCHEMA,
+                          compression='snappy', use_dictionary=['PATIENT_ID']) as parquet_writer:
+        tables = []
+        num_rows = 0
+        for file_path in file_paths:
+            file_name, time_series, fingerprint = load_mat_file(file_path)
+            manifest.append([file_path] + fingerprint)
+            tables.append(convert_mat_to_table(file_name, time_series))
+            num_rows += tables[-1].num_rows
+
+            # Only write full row groups, the remaining rows are kept for the next row group
+            while num_rows >= row_group_size:
+                table = pa.concat_tables(tables)
+                parquet_writer.write_table(table.slice(0, row_group_size), row_group_size=row_group_size)
+                tables = [table.slice(row_group_size)]
+                num_rows -= row_group_size
+
+        if num_rows > 0:
+            parquet_writer.write_table(pa.concat_tables(tables), row_group_size=row_group_size)
+
+    write_manifest(output_path, [entry + [[os.path.getsize(output_path)]] for entry in manifest])
+    return len(file_paths)
+
+
+def convert_mat_to_table(file_name, time_series):
+    tensions = np.asarray(time_series, dtype=np.int16)[:12, :5000].ravel()
+    patient_ids = pa.DictionaryArray.from_arrays(pa.array(np.zeros(tensions.size, dtype=np.int32)),
+                                                 pa.array([file_name]))
+    timestamps = pa.array(np.arange(1, tensions.size + 1, dtype=np.int32))
+    return pa.Table.from_arrays([patient_ids, timestamps, pa.array(tensions)], schema=DIM_LEAD_PARQUET_SCHEMA)
+
+
+def print_throughput(num_records, start_time):
+    time_delta = datetime.now() - start_time
+    seconds = max(time_delta.total_seconds(), 1e-9)
+    print(f'Converted {num_records} records in {time_delta} ({num_records / seconds:.1f} records/s)')
+
+
+def write_mat_file_to_csv(file_path, csv_file):
+    file_name, time_series, fingerprint = load_mat_file(file_path)
+
+    # Writing all tensions to a csv-file dim_lead_*.csv in one bulk write
+    csv_file.write(format_mat_rows(file_name, time_series))
+    return fingerprint
+
+
+def load_mat_file(file_path):
+    # Load .mat file and convert to a dictionary, the bytes are read once for both loadmat and the manifest
+    with open(f'{file_path}.mat', 'rb') as mat_file:
+        content = mat_file.read()
+    data_dict = sc.loadmat(io.BytesIO(content))
     file_name = os.path.basename(file_path)
-    time_series = data_dict['val']
+    return file_name, data_dict['val'], get_fingerprint(f'{file_path}.mat', content)
 
-    # Writing each tension to a csv-file dim_lead_*.csv
-    for i in range(12):
-        row_data = [(file_name, i * 5000 + j + 1, time_series[i][j]) for j in range(5000)]
-        writer.writerows(row_data)
 
+def format_mat_rows(file_name, time_series):
+    # Build all 'PATIENT_ID,TIMESTAMP,TENSION' rows of a record at once. Every row is laid out in a
+    # fixed-width byte matrix, the padding bytes are masked away and the rest is joined into one block.
+    tensions = np.asarray(time_series)[:12, :5000].ravel().astype(np.int32)
+    prefix = np.frombuffer(f'{file_name},'.encode(), dtype=np.uint8)
+    timestamp_bytes, timestamp_mask = get_timestamp_bytes(tensions.size)
+    tension_bytes, tension_mask = get_digit_bytes(np.abs(tensions))
 
-def convert_mat_to_df(uploaded_file, patient_id):
-    # Extract the data from time_series using numpy
+    width = prefix.size + timestamp_bytes.shape[1] + 1 + tension_bytes.shape[1] + 2
+    rows = np.empty((tensions.size, width), dtype=np.uint8)
+    mask = np.ones((tensions.size, width), dtype=bool)
+
+    column = prefix.size
+    rows[:, :column] = prefix
+    rows[:, column:column + timestamp_bytes.shape[1]] = timestamp_bytes
+    mask[:, column:column + timestamp_bytes.shape[1]] = timestamp_mask
+    column += timestamp_bytes.shape[1]
+    rows[:, column] = ord('-')
+    mask[:, column] = tensions < 0
+    column += 1
+    rows[:, column:column + tension_bytes.shape[1]] = tension_bytes
+    mask[:, column:column + tension_bytes.shape[1]] = tension_mask
+    rows[:, -2:] = np.frombuffer(b'\r\n', dtype=np.uint8)
+
+    return rows[mask].tobytes().decode('ascii')
 
-    data = []
 
-    for i in range(12):
-        for j in range(5000):
-            data.append(uploaded_file[i][j])
+@lru_cache(maxsize=4)
+def get_timestamp_bytes(num_rows):
+    # The 'TIMESTAMP,' columns are the same for every record, so they are only built once
+    timestamp_bytes, timestamp_mask = get_digit_bytes(np.arange(1, num_rows + 1))
+    timestamp_bytes = np.hstack([timestamp_bytes, np.full((num_rows, 1), ord(','), dtype=np.uint8)])
+    timestamp_mask = np.hstack([timestamp_mask, np.ones((num_rows, 1), dtype=bool)])
+    return timestamp_bytes, timestamp_mask
+
+
+def get_digit_bytes(values, num_digits=5):
+    # Right-aligned ASCII digits of non-negative integers and a mask without the leading zeros
+    powers = 10 ** np.arange(num_digits - 1, -1, -1)
+    digits = (values[:, None] // powers % 10 + ord('0')).astype(np.uint8)
+    lengths = 1 + (values[:, None] >= powers[:-1]).sum(axis=1)
+    mask = np.arange(num_digits) >= num_digits - lengths[:, None]
+    return digits, mask
+
+
+def convert_mat_to_df(uploaded_file, patient_id):
+    # Extract the data from time_series using numpy, lead by lead like the rows of dim_lead
+    tensions = np.asarray(uploaded_file)[:12, :5000].ravel().astype(np.int16)
 
     # Create the DataFrame
-    df = pd.DataFrame({'PATIENT_ID': patient_id, 'TIMESTAMP': range(60000), 'TENSION': data})
+    df = pd.DataFrame({'PATIENT_ID': np.full(tensions.size, patient_id, dtype=object),
+                       'TIMESTAMP': np.arange(tensions.size, dtype=np.int32),
+                       'TENSION': tensions})
 
     return df
@@ -0,0 +1,415 @@
+import glob
+import gzip
+import hashlib
+import importlib
+import os
+import re
+import shutil
+import sys
+import threading
+from datetime import datetime
+from decimal import Decimal
+
+import duckdb
+
+import config
+
+
+# Stand-in for snowflake.snowpark.Session on an embedded DuckDB database with directory-backed stages.
+# It understands the Snowflake statements this project sends (stages, PUT, COPY INTO, stored procedures)
+# so the data paths can be run and measured on a laptop.
+class LocalSession:
+    def __init__(self, database=config.local_database, stage_directory=config.local_stage_directory):
+        if database != ':memory:':
+            os.makedirs(os.path.dirname(database) or '.', exist_ok=True)
+        os.makedirs(stage_directory, exist_ok=True)
+
+        self.database = duckdb.connect(database)
+        self.cursors = threading.local()
+        self.stage_directory = stage_directory
+        self.file = LocalFileOperation(self)
+
+        # Snowflake metadata that DuckDB does not have, kept in tables so it survives a restart
+        self.connection.execute('CREATE TABLE IF NOT EXISTS LOCAL_FILE_FORMAT ('
+                                'name VARCHAR PRIMARY KEY, format_type VARCHAR)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS LOCAL_STAGE ('
+                                'name VARCHAR PRIMARY KEY, file_format VARCHAR)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS LOCAL_PROCEDURE ('
+                                'name VARCHAR PRIMARY KEY, handler VARCHAR, imports VARCHAR, parameter_types VARCHAR)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS LOCAL_LOAD_HISTORY ('
+                                'table_name VARCHAR, file_name VARCHAR, md5 VARCHAR, last_load_time TIMESTAMP)')
+
+    @property
+    def connection(self):
+        # A DuckDB connection can not run statements from several threads at once, Keras fetches its batches on
+        # other threads than the one that trains, so every thread gets its own cursor on the database
+        if not hasattr(self.cursors, 'cursor'):
+            self.cursors.cursor = self.database.cursor()
+        return self.cursors.cursor
+
+    def sql(self, query):
+        return LocalDataFrame(self, query)
+
+    def table(self, table_name):
+        return LocalDataFrame(self, f'SELECT * FROM {table_name}')
+
+    def write_pandas(self, df, table_name, overwrite=False, **kwargs):
+        if overwrite:
+            self.connection.execute(f'DELETE FROM {table_name}')
+
+        columns = ', '.join(f'"{column}"' for column in df.columns)
+        self.connection.register('LOCAL_WRITE_PANDAS', df)
+        try:
+            self.connection.execute(f'INSERT INTO {table_name} ({columns}) SELECT {columns} FROM LOCAL_WRITE_PANDAS')
+        finally:
+            self.connection.unregister('LOCAL_WRITE_PANDAS')
+        return self.table(table_name)
+
+    def close(self):
+        self.database.close()
+
+    def execute(self, query):
+        # Returns the column names and rows of a statement
+        query = query.strip().rstrip(';')
+        for pattern, handler in [
+            (r'USE\s', self.execute_noop),
+            (r'ALTER SESSION\s', self.execute_noop),
+            (r'ALTER TABLE \w+ CLUSTER BY\s', self.execute_noop),
+            (r'ALTER TABLE \w+ ADD SEARCH OPTIMIZATION\s', self.execute_add_search_optimization),
+            (r'CREATE (OR REPLACE )?(WAREHOUSE|DATABASE|SCHEMA)\s', self.execute_noop),
+            (r'CREATE (OR REPLACE )?FILE FORMAT\s', self.execute_create_file_format),
+            (r'CREATE (OR REPLACE )?STAGE\s', self.execute_create_stage),
+            (r'CREATE (OR REPLACE )?PROCEDURE\s', self.execute_create_procedure),
+            (r'PUT\s', self.execute_put),
+            (r'LIST\s', self.execute_list),
+            (r'REMOVE\s', self.execute_remove),
+            (r'COPY INTO\s', self.execute_copy),
+            (r'CALL\s', self.execute_call),
+        ]:
+            if re.match(pattern, query, re.IGNORECASE):
+                return handler(query)
+
+        create_table = re.match(r'CREATE (OR REPLACE )?(TRANSIENT )?TABLE (IF NOT EXISTS )?(\w+)', query, re.IGNORECASE)
+        if create_table:
+            # A replaced table has a new load history, like in Snowflake
+            replace, table_name = create_table.group(1), create_table.group(4).upper()
+            if replace:
+                self.connection.execute('DELETE FROM LOCAL_LOAD_HISTORY WHERE table_name = ?', [table_name])
+
+            # AUTOINCREMENT columns get their values from a sequence
+            autoincrement = re.search(r'(\w+) NUMBER NOT NULL AUTOINCREMENT START (\d+) INCREMENT (\d+)', query,
+                                      re.IGNORECASE)
+            if autoincrement:
+                column, start, increment = autoincrement.groups()
+                sequence = f'{table_name}_{column.upper()}_SEQUENCE'
+                create_sequence = 'CREATE OR REPLACE SEQUENCE' if replace else 'CREATE SEQUENCE IF NOT EXISTS'
+                self.connection.execute(f'{create_sequence} {sequence} START {start} INCREMENT {increment}')
+                query = query.replace(autoincrement.group(0), f'{column} BIGINT DEFAULT nextval(\'{sequence}\') NOT NULL')
+
+        return self.fetch(translate_sql(query))
+
+    def fetch(self, query, parameters=None):
+        result = self.connection.execute(query, parameters)
+        if result.description is None:
+            return [], []
+        columns = [column[0].upper() for column in result.description]
+        rows = result.fetchall()
+        if columns == ['COUNT'] and len(rows) == 0:
+            return [], []
+        return columns, rows
+
+    def execute_noop(self, query):
+        return ['STATUS'], [('Statement executed successfully.',)]
+
+    def execute_add_search_optimization(self, query):
+        # DuckDB has no search optimization service, an index on the column serves the same equality lookups.
+        # A clustering key needs nothing: DuckDB prunes row groups on min/max, which works when rows are loaded
+        # in order.
+        table_name, column = re.match(r'ALTER TABLE (\w+) ADD SEARCH OPTIMIZATION ON EQUALITY\((\w+)\)', query,
+                                      re.IGNORECASE).groups()
+        self.connection.execute(f'CREATE INDEX IF NOT EXISTS {table_name}_{column}_INDEX ON {table_name} ({column})')
+        return self.execute_noop(query)
+
+    def execute_create_file_format(self, query):
+        match = re.match(r'CREATE (?:OR REPLACE )?FILE FORMAT (\w+) TYPE = (.+)$', query, re.IGNORECASE | re.DOTALL)
+        name, format_type = match.group(1).upper(), match.group(2).strip()
+        self.connection.execute('INSERT OR REPLACE INTO LOCAL_FILE_FORMAT VALUES (?, ?)', [name, format_type])
+        return ['STATUS'], [(f'File format {name} successfully created.',)]
+
+    def execute_create_stage(self, query):
+        match = re.match(r'CREATE (?:OR REPLACE )?STAGE (\w+)(?: FILE_FORMAT = (\w+))?', query, re.IGNORECASE)
+        name = match.group(1).upper()
+        file_format = match.group(2).upper() if match.group(2) else None
+
+        # A replaced stage starts empty
+        shutil.rmtree(self.get_stage_path(name), ignore_errors=True)
+        os.makedirs(self.get_stage_path(name))
+        self.connection.execute('INSERT OR REPLACE INTO LOCAL_STAGE VALUES (?, ?)', [name, file_format])
+        return ['STATUS'], [(f'Stage area {name} successfully created.',)]
+
+    def execute_create_procedure(self, query):
+        match = re.match(r'CREATE (?:OR REPLACE )?PROCEDURE (\w+)\((.*?)\)', query, re.IGNORECASE)
+        name = match.group(1).upper()
+        parameter_types = [parameter.split()[-1].upper() for parameter in match.group(2).split(',') if parameter]
+        handler = re.search(r"HANDLER = '([\w.]+)'", query, re.IGNORECASE).group(1)
+        imports = re.search(r'IMPORTS = \((.*?)\)', query, re.IGNORECASE)
+        imports = re.findall(r"'@([^']+)'", imports.group(1)) if imports else []
+
+        self.connection.execute('INSERT OR REPLACE INTO LOCAL_PROCEDURE VALUES (?, ?, ?, ?)',
+                                [name, handler, ','.join(imports), ','.join(parameter_types)])
+        return ['STATUS'], [(f'Function {name} successfully created.',)]
+
+    def execute_call(self, query):
+        match = re.match(r'CALL (\w+)\((.*)\)$', query, re.IGNORECASE | re.DOTALL)
+        name = match.group(1).upper()
+        procedure = self.connection.execute('SELECT handler, imports, parameter_types FROM LOCAL_PROCEDURE '
+                                            'WHERE name = ?', [name]).fetchone()
+        if procedure is None:
+            raise ValueError(f'Unknown stored procedure {name}')
+        handler, imports, parameter_types = procedure
+
+        # Evaluate the arguments as SQL literals and convert them to the declared parameter types
+        arguments = []
+        if match.group(2).strip():
+            arguments = list(self.connection.execute(f'SELECT {translate_sql(match.group(2))}').fetchone())
+        for i, parameter_type in enumerate(filter(None, parameter_types.split(','))):
+            if parameter_type in ('FLOAT', 'DOUBLE', 'REAL') and isinstance(arguments[i], Decimal):
+                arguments[i] = float(arguments[i])
+            elif parameter_type in ('NUMBER', 'INT', 'INTEGER') and isinstance(arguments[i], Decimal):
+                arguments[i] = int(arguments[i])
+
+        # Like Snowflake, the staged imports are available in the import directory of the procedure
+        import_directory = os.path.join(self.stage_directory, '.imports', name)
+        os.makedirs(import_directory, exist_ok=True)
+        for staged_file in filter(None, imports.split(',')):
+            stage, _, path = staged_file.partition('/')
+            source = os.path.join(self.get_stage_path(stage), path)
+            target = os.path.join(import_directory, os.path.basename(path))
+            if not os.path.exists(target) or os.path.getmtime(target) < os.path.getmtime(source):
+                shutil.copy2(source, target)
+        sys._xoptions['snowflake_import_directory'] = import_directory + os.sep
+
+        module_name, function_name = handler.rsplit('.', 1)
+        function = getattr(importlib.import_module(module_name), function_name)
+        return [name], [(function(self, *arguments),)]
+
+    def execute_put(self, query):
+        match = re.match(r'PUT file://(\S+) @(\S+)(.*)$', query, re.IGNORECASE | re.DOTALL)
+        options = match.group(3).upper()
+        return self.put(match.group(1), match.group(2),
+                        auto_compress='AUTO_COMPRESS = FALSE' not in options,
+                        overwrite='OVERWRITE = TRUE' in options)
+
+    def put(self, local_file_name, stage_location, auto_compress=True, overwrite=False):
+        stage, _, prefix = stage_location.lstrip('@').partition('/')
+        target_directory = os.path.join(self.get_stage_path(stage), prefix)
+        os.makedirs(target_directory, exist_ok=True)
+
+        rows = []
+        for source in sorted(glob.glob(get_local_path(local_file_name))):
+            target_name = os.path.basename(source) + ('.gz' if auto_compress else '')
+            target = os.path.join(target_directory, target_name)
+            if os.path.exists(target) and not overwrite:
+                rows.append((os.path.basename(source), target_name, os.path.getsize(source),
+                             os.path.getsize(target), 'SKIPPED'))
+                continue
+
+            if auto_compress:
+                with open(source, 'rb') as source_file, gzip.open(target, 'wb', compresslevel=1) as target_file:
+                    shutil.copyfileobj(source_file, target_file)
+            else:
+                shutil.copyfile(source, target)
+            rows.append((os.path.basename(source), target_name, os.path.getsize(source),
+                         os.path.getsize(target), 'UPLOADED'))
+        return ['SOURCE', 'TARGET', 'SOURCE_SIZE', 'TARGET_SIZE', 'STATUS'], rows
+
+    def execute_list(self, query):
+        stage_location = re.match(r'LIST @(\S+)', query, re.IGNORECASE).group(1)
+        stage, _, prefix = stage_location.partition('/')
+        rows = []
+        for path in self.get_stage_files(stage, prefix):
+            stat = os.stat(path)
+            rows.append((f'{stage.lower()}/{os.path.relpath(path, self.get_stage_path(stage))}', stat.st_size,
+                         get_md5(path), datetime.fromtimestamp(stat.st_mtime)))
+        return ['NAME', 'SIZE', 'MD5', 'LAST_MODIFIED'], rows
+
+    def execute_remove(self, query):
+        match = re.match(r'REMOVE @(\S+?)(?:\s+PATTERN = \'(.*)\')?$', query, re.IGNORECASE)
+        stage, _, prefix = match.group(1).partition('/')
+        rows = []
+        for path in self.get_stage_files(stage, prefix):
+            name = f'{stage.lower()}/{os.path.relpath(path, self.get_stage_path(stage))}'
+            if match.group(2) is None or re.fullmatch(match.group(2), name):
+                os.remove(path)
+                rows.append((name, 'removed'))
+        return ['NAME', 'RESULT'], rows
+
+    def execute_copy(self, query):
+        match = re.match(r'COPY INTO (\w+)\s+FROM\s+(?:\(\s*SELECT (.+?) FROM @(\S+?)\s*\)|@(\S+))\s+'
+                         r'FILE_FORMAT = \(\s*FORMAT_NAME = \'?(\w+)\'?\s*\)(.*)$', query, re.IGNORECASE | re.DOTALL)
+        table_name, columns = match.group(1).upper(), match.group(2)
+        stage_location = match.group(3) or match.group(4)
+        format_type = self.connection.execute('SELECT format_type FROM LOCAL_FILE_FORMAT WHERE name = ?',
+                                              [match.group(5).upper()]).fetchone()[0].upper()
+        force = 'FORCE = TRUE' in match.group(6).upper()
+        purge = 'PURGE = TRUE' in match.group(6).upper()
+
+        # Files that were loaded before with the same checksum are skipped, like the Snowflake load history
+        stage, _, prefix = stage_location.partition('/')
+        files = []
+        for path in self.get_stage_files(stage, prefix):
+            md5 = get_md5(path)
+            loaded = self.connection.execute('SELECT COUNT(*) FROM LOCAL_LOAD_HISTORY '
+                                             'WHERE table_name = ? AND file_name = ? AND md5 = ?',
+                                             [table_name, path, md5]).fetchone()[0]
+            if force or loaded == 0:
+                files.append((path, md5))
+
+        if len(files) == 0:
+            return ['STATUS'], [('Copy executed with 0 files processed.',)]
+
+        # All new files are loaded with one statement, csv files with only a header are just recorded as loaded
+        skip = re.search(r'SKIP_HEADER = (\d+)', format_type)
+        skip = int(skip.group(1)) if skip else 0
+        paths = [path for path, _ in files if format_type.startswith('PARQUET') or has_csv_rows(path, skip)]
+        rows_loaded = self.insert_files(table_name, columns, format_type, paths, skip) if paths else 0
+
+        load_time = datetime.now()
+        self.connection.executemany('INSERT INTO LOCAL_LOAD_HISTORY VALUES (?, ?, ?, ?)',
+                                    [[table_name, path, md5, load_time] for path, md5 in files])
+
+        # PURGE removes the loaded files from the stage
+        if purge:
+            for path, _ in files:
+                os.remove(path)
+        return ['FILES_LOADED', 'ROWS_LOADED'], [(len(files), rows_loaded)]
+
+    def insert_files(self, table_name, columns, format_type, paths, skip):
+        paths = ', '.join(f'\'{path}\'' for path in paths)
+        if format_type.startswith('PARQUET'):
+            source = f'read_parquet([{paths}])'
+            select = re.sub(r'\$1:(\w+)', r'"\1"', columns) if columns else '*'
+        else:
+            source = (f'read_csv([{paths}], header = false, skip = {skip}, '
+                      f'all_varchar = true, compression = \'auto\')')
+            select = re.sub(r'\$(\d+)', lambda m: f'column{int(m.group(1)) - 1}', columns) if columns else '*'
+        return self.connection.execute(f'INSERT INTO {table_name} '
+                                       f'SELECT {translate_sql(select)} FROM {source}').fetchone()[0]
+
+    def get_stage_path(self, stage):
+        return os.path.join(self.stage_directory, stage.upper())
+
+    def get_stage_files(self, stage, prefix=''):
+        stage_path = self.get_stage_path(stage)
+        paths = []
+        for directory, _, file_names in os.walk(stage_path):
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+                if os.path.relpath(path, stage_path).replace(os.sep, '/').startswith(prefix):
+                    paths.append(path)
+        return sorted(paths)
+
+
+class LocalDataFrame:
+    def __init__(self, session, query):
+        self.session = session
+        self.query = query
+
+    def collect(self):
+        return self.session.execute(self.query)[1]
+
+    def to_pandas(self):
+        import pandas as pd
+
+        columns, rows = self.session.execute(self.query)
+        return pd.DataFrame.from_records(rows, columns=columns)
+
+    def to_pandas_batches(self, batch_size=100000):
+        import pandas as pd
+
+        # The batches are read while the caller runs other statements, like Snowpark's open result set, so the
+        # query gets a cursor of its own instead of the one of the thread
+        cursor = self.session.database.cursor()
+        try:
+            result = cursor.execute(translate_sql(self.query))
+            columns = [column[0].upper() for column in result.description]
+            while True:
+                rows = result.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                yield pd.DataFrame.from_records(rows, columns=columns)
+        finally:
+            cursor.close()
+
+
+class LocalFileOperation:
+    def __init__(self, session):
+        self.session = session
+
+    def put(self, local_file_name, stage_location, auto_compress=True, overwrite=False, **kwargs):
+        return self.session.put(local_file_name, stage_location, auto_compress, overwrite)[1]
+
+
+def translate_sql(query):
+    # Rewrite the Snowflake dialect used in this project into DuckDB SQL. The string literals are set aside first
+    # so values that contain keywords are left alone, and the constraints are only stripped from DDL statements.
+    literals = []
+
+    def set_aside(match):
+        literals.append(match.group(0))
+        return f'\x00{len(literals) - 1}\x00'
+
+    query = re.sub(r"'(?:[^']|'')*'", set_aside, query)
+    replacements = [
+        (r'LISTAGG\((.+?)\)\s+WITHIN GROUP\s+\((ORDER BY [^)]+)\)', r'LISTAGG(\1 \2)'),
+        (r'\bNUMBER\(\s*\d+\s*,\s*0\s*\)', 'BIGINT'),
+        (r'\bNUMBER\(\s*(\d+)\s*,\s*(\d+)\s*\)', r'DECIMAL(\1, \2)'),
+        (r'\bNUMBER\b', 'BIGINT'),
+        (r'(?<!_)\bBINARY\b', 'BLOB'),
+        (r'\bBASE64_ENCODE\(', 'BASE64('),
+        (r'\bARRAY_CONSTRUCT\(', 'LIST_VALUE('),
+        (r'\b(\w+)\.NEXTVAL\b', r"nextval('\1')"),
+        (r'\bTABLE\(GENERATOR\(ROWCOUNT => (\d+)\)\)', r'range(\1)'),
+    ]
+    if re.match(r'\s*(CREATE|ALTER)\b', query, flags=re.IGNORECASE):
+        replacements += [
+            (r'\bTRANSIENT TABLE\b', 'TABLE'),
+            (r'\s+REFERENCES \w+ \(\w+\)', ''),
+            (r'\s+PRIMARY KEY\b', ''),
+            (r'\s+UNIQUE\b', ''),
+        ]
+    for pattern, replacement in replacements:
+        query = re.sub(pattern, replacement, query, flags=re.IGNORECASE | re.DOTALL)
+
+    # TO_BINARY(x, 'BASE64'), its format is one of the literals that were set aside
+    def from_base64(match):
+        if literals[int(match.group(2))].upper() != "'BASE64'":
+            return match.group(0)
+        return f'FROM_BASE64({match.group(1)})'
+
+    query = re.sub(r'\bTO_BINARY\(([^,()]+),\s*\x00(\d+)\x00\)', from_base64, query, flags=re.IGNORECASE)
+    return re.sub(r'\x00(\d+)\x00', lambda match: literals[int(match.group(1))], query)
+
+
+def get_local_path(local_file_name):
+    # The project uses Windows paths like C:csv_files\fact_patient.csv
+    if os.name != 'nt':
+        local_file_name = re.sub(r'^[A-Za-z]:', '', local_file_name).replace('\\', '/')
+    return local_file_name
+
+
+def has_csv_rows(path, skip=0):
+    # DuckDB can not read a csv file without rows, Snowflake just loads nothing from it
+    with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path, 'r')) as csv_file:
+        for i, line in enumerate(csv_file):
+            if i >= skip and line.strip():
+                return True
+    return False
+
+
+def get_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
@@ -5,13 +5,14 @@ import snowflake_functions
 
 if __name__ == "__main__":
     # Convert all data to local csv-files
-    local_functions.convert_files_locally(mat_files=False, hea_files=False)
+    local_functions.convert_files_locally(mat_files=False, hea_files=False, processes=8, ecg_store=False)
 
     # Connect to snowflake
     session = snowflake_functions.get_session(initialize=False)
 
-    # Upload, create tables and copy into all csv-files
-    snowflake_functions.process_csv_files(upload=False, create_tables=False, copy=False, session=session)
+    # Upload, create tables and copy into all csv-files (incremental only loads what changed since the last load)
+    snowflake_functions.process_csv_files(upload=False, create_tables=False, copy=False, session=session,
+                                          incremental=False)
 
     # Upload py-files to import in stored procedures
     snowflake_functions.upload_py_files(upload=False, session=session)
@@ -33,6 +34,12 @@ if __name__ == "__main__":
     # # Create stored procedure: predict
     # snowflake_functions.create_stored_procedure_predict(session, 'model_functions',
     #                                                     model_functions.predict.__name__,
-    #                                                     'STRING', ['tensions'], ['STRING'])
+    #                                                     'STRING', ['tensions', 'threshold'], ['STRING', 'FLOAT'])
+    #
+    # # Create stored procedure: predict_patients
+    # snowflake_functions.create_stored_procedure_predict(session, 'model_functions',
+    #                                                     model_functions.predict_patients.__name__,
+    #                                                     'STRING', ['patient_ids', 'threshold'],
+    #                                                     ['ARRAY', 'FLOAT'])
 
     print(model_functions.predict_with_patient_id(session, 'JS00013'))
@@ -1,42 +1,56 @@
+import base64
+import json
+import math
 import os
 import sys
+import time
+from functools import partial
 
+import numpy as np
 import pandas as pd
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import MultiLabelBinarizer
 from tensorflow.python.keras.layers import *
 from tensorflow.python.keras.models import Sequential
 from tensorflow.python.keras.models import load_model
-from tensorflow.python.keras.utils.all_utils import normalize
 
+import bulk_functions
 import config
+import signal_functions
 
+# Number of tensions of one ECG (12 leads x 5000 samples)
+NUM_TENSIONS = 60000
 
-def train_model(session):
-    # Create table tensions_diseases
-    session.sql(f'CREATE OR REPLACE TABLE {config.table_tensions_diseases} ('
-                f'tensions STRING, '
-                f'diseases STRING)').collect()
+# Number of predictions the inference latency of a trained model is measured over
+LATENCY_REPEATS = 10
+
+# Number of patients whose tensions are held in memory while training streams an epoch from the warehouse,
+# the batches are shuffled within these chunks
+TRAINING_CHUNK_SIZE = 4096
+
+# Number of patients whose tensions and diseases are aggregated and merged into tensions_diseases at a time
+MERGE_BATCH_SIZE = 5000
+
+# Process-level cache of loaded models: model path -> ((mtime, size), model). A newly trained my_model.h5
+# has another mtime and size, so the predict procedure loads it on its next call
+model_cache = {}
+model_cache_stats = {'hits': 0, 'misses': 0}
+
+# Label -> disease mapping of the cached models: model path -> ((mtime, size), labels)
+label_cache = {}
 
-    # Insert training data into table tensions_diseases
-    session.sql(f'INSERT INTO {config.table_tensions_diseases} ('
-                f'SELECT t1.tensions, t2.diseases '
-                f'FROM ('
-                f'SELECT l.patient_id, '
-                f'LISTAGG(l.tension, \',\') WITHIN GROUP (ORDER BY l.timestamp) AS tensions '
-                f'FROM {config.dim_lead} l GROUP BY l.patient_id) t1 '
-                f'JOIN ('
-                f'SELECT d.patient_id, '
-                f'LISTAGG(d.disease_info_id, \',\') WITHIN GROUP (ORDER BY d.disease_info_id) AS diseases '
-                f'FROM {config.dim_disease} d GROUP BY d.patient_id) t2 '
-                f'ON t1.patient_id = t2.patient_id '
-                f'ORDER BY t1.patient_id)').collect()
-
-    # Get table tensions_diseases into a pandas dataframe
-    train_data = session.table(config.table_tensions_diseases).to_pandas()
+
+def train_model(session, batch_size=32):
+    # Bring tensions_diseases up to date, only the patients that are not in it yet are aggregated
+    create_training_table(session)
+    merge_training_features(session)
+
+    # Only get the diseases into a pandas dataframe, the tensions are streamed in batches while training
+    train_data = session.sql(f'SELECT patient_id, diseases FROM {config.table_tensions_diseases} '
+                             f'ORDER BY patient_id').to_pandas()
+    patient_ids = train_data['PATIENT_ID'].to_numpy(dtype=object)
 
     # Data preprocessing
-    tensions = normalize(train_data['TENSIONS'].str.split(',', expand=True).astype(int), axis=1)
     diseases = train_data['DISEASES'].str.split(',', expand=True).astype(float).fillna(0)
 
     # Extracting diseases as labels
@@ -48,90 +62,423 @@ def train_model(session):
                 f'label_id NUMBER(2, 0), '
                 f'disease_info_id NUMBER(9, 0))').collect()
 
-    label_id = 0
-    for label in mlb.classes_:
-        session.sql(
-            f'INSERT INTO {config.table_model_labels} '
-            f'(label_id, disease_info_id) '
-            f'VALUES ({label_id}, {label})').collect()
-        label_id += 1
+    # All labels with one multi-row insert
+    bulk_functions.insert_rows(session, config.table_model_labels, ['label_id', 'disease_info_id'],
+                               [[label_id, int(label)] for label_id, label in enumerate(mlb.classes_)])
+
+    # Split the patients into a train and test set for the tensions and diseases
+    ids_train, ids_test, y_train, y_test = train_test_split(patient_ids, diseases, test_size=0.2, train_size=0.8,
+                                                            shuffle=True)
 
-    # Split the data into a train and test set for the tensions and diseases
-    x_train, x_test, y_train, y_test = train_test_split(tensions, diseases, test_size=0.2, train_size=0.8, shuffle=True)
+    # Batches of preprocessed tensions, sliced from the local ECG store when it has every patient,
+    # otherwise streamed from the warehouse with one query per epoch
+    get_batch = get_store_training_tensions(patient_ids)
+    if get_batch is not None:
+        train_batches = iterate_training_batches(get_batch, ids_train, y_train, batch_size, shuffle=True)
+        test_batches = iterate_training_batches(get_batch, ids_test, y_test, batch_size)
+    else:
+        create_training_split(session, ids_train, ids_test)
+        train_batches = iterate_table_batches(session, 'train', ids_train, y_train, batch_size, shuffle=True)
+        test_batches = iterate_table_batches(session, 'test', ids_test, y_test, batch_size)
 
     # Create the model
-    model = Sequential()
-    model.add(InputLayer(input_shape=x_train.shape[1]))
-    model.add(Dense(128, kernel_initializer='he_uniform', activation='relu'))
-    model.add(Dense(64))
-    model.add(Dense(y_train.shape[1], activation='sigmoid'))
-    model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
+    model = create_model(signal_functions.get_num_features(), y_train.shape[1], config.model_architecture)
 
     # Train the model
-    history = model.fit(x_train, y_train, epochs=20, validation_data=(x_test, y_test))
+    history = model.fit(train_batches, steps_per_epoch=math.ceil(len(ids_train) / batch_size), epochs=20,
+                        validation_data=test_batches, validation_steps=math.ceil(len(ids_test) / batch_size))
 
     loss = history.history['loss'][-1]
     accuracy = history.history['accuracy'][-1]
     val_loss = history.history['val_loss'][-1]
     val_accuracy = history.history['val_accuracy'][-1]
 
-    # Save the model to a Snowflake stage
+    # Save the model to a Snowflake stage, without the optimizer state that only training needs
     model_file = os.path.join('/tmp', 'my_model.h5')
-    model.save(model_file)
+    model.save(model_file, include_optimizer=False)
     session.file.put(model_file, f'@{config.models_stage}', auto_compress=False, overwrite=True)
+    file_size = os.path.getsize(model_file)
+    latency = get_inference_latency(model)
 
     return f'\tTraining results:\n' \
            f'\t\tLoss: {loss}\n' \
            f'\t\tAccuracy: {accuracy}\n' \
            f'\t\tVal loss: {val_loss}\n' \
-           f'\t\tVal accuracy: {val_accuracy}'
+           f'\t\tVal accuracy: {val_accuracy}\n' \
+           f'\tModel ({config.model_architecture}):\n' \
+           f'\t\tParameters: {model.count_params()}\n' \
+           f'\t\tMultiply-adds per ECG: {count_multiply_adds(model)}\n' \
+           f'\t\tFile size: {file_size / 1024:.1f} KB\n' \
+           f'\t\tInference latency: {latency * 1000:.2f} ms per ECG'
+
+
+def create_model(num_inputs, num_labels, architecture='dense'):
+    model = Sequential()
+    model.add(InputLayer(input_shape=num_inputs))
+    if architecture == 'dense':
+        model.add(Dense(128, kernel_initializer='he_uniform', activation='relu'))
+        model.add(Dense(64))
+    elif architecture == 'cnn':
+        # The flat input holds the leads one after the other, the convolutions run along the time axis
+        # with the 12 leads as channels. The first layers are narrow and take large strides, because the
+        # leads are longest there, the pooling drops the time axis.
+        model.add(Reshape((signal_functions.NUM_LEADS, -1)))
+        model.add(Permute((2, 1)))
+        model.add(Conv1D(8, 5, strides=5, padding='same', kernel_initializer='he_uniform', activation='relu'))
+        model.add(Conv1D(16, 5, strides=4, padding='same', kernel_initializer='he_uniform', activation='relu'))
+        model.add(Conv1D(32, 3, strides=2, padding='same', kernel_initializer='he_uniform', activation='relu'))
+        model.add(Conv1D(32, 3, strides=2, padding='same', kernel_initializer='he_uniform', activation='relu'))
+        model.add(GlobalAveragePooling1D())
+    else:
+        raise ValueError(f'Unknown model architecture: {architecture}')
+    model.add(Dense(num_labels, activation='sigmoid'))
+    model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
+    return model
+
+
+def count_multiply_adds(model):
+    # Multiply-adds of the prediction of one ECG in the Dense and Conv1D layers, the other layers add little
+    multiply_adds = 0
+    for layer in model.layers:
+        if isinstance(layer, Conv1D):
+            multiply_adds += layer.output_shape[1] * int(np.prod(layer.kernel.shape))
+        elif isinstance(layer, Dense):
+            multiply_adds += int(np.prod(layer.kernel.shape))
+    return multiply_adds
+
+
+def get_inference_latency(model, repeats=LATENCY_REPEATS):
+    # Median seconds of the prediction of one ECG on the CPU, preprocessing included, like in predict
+    tensions = np.zeros((1, NUM_TENSIONS), dtype=np.float32)
+    run_model(model, get_model_input(model, tensions))
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run_model(model, get_model_input(model, tensions))
+        seconds.append(time.perf_counter() - start)
+    return float(np.median(seconds))
+
+
+def create_training_table(session, replace=False):
+    # Table tensions_diseases with one row of tensions and diseases per patient, it is kept between trainings.
+    # After a switch of the lead layout its tensions have the other type, so it is replaced and aggregated again.
+    tensions_type = session.sql(f'SELECT data_type FROM information_schema.columns '
+                                f'WHERE table_schema = CURRENT_SCHEMA() '
+                                f'AND UPPER(table_name) = \'{config.table_tensions_diseases}\' '
+                                f'AND UPPER(column_name) = \'TENSIONS\'').collect()
+    if tensions_type and (tensions_type[0][0].upper() in ('BINARY', 'BLOB')) != (config.lead_layout == 'wide'):
+        replace = True
+
+    create_table = 'CREATE OR REPLACE TABLE' if replace else 'CREATE TABLE IF NOT EXISTS'
+    session.sql(f'{create_table} {config.table_tensions_diseases} ('
+                f'patient_id VARCHAR(7), '
+                f'tensions {"BINARY" if config.lead_layout == "wide" else "STRING"}, '
+                f'diseases STRING)').collect()
+
+
+def merge_training_features(session, patient_ids=None):
+    # Aggregate the tensions and diseases of patients and merge them into tensions_diseases. Without patient_ids
+    # these are the patients with diseases that are not in the table yet, e.g. after a load. Returns the number
+    # of patients that were merged.
+    if patient_ids is None:
+        patient_ids = [row[0] for row in session.sql(
+            f'SELECT DISTINCT d.patient_id FROM {config.dim_disease} d '
+            f'WHERE d.patient_id NOT IN (SELECT patient_id FROM {config.table_tensions_diseases})').collect()]
+
+    for i in range(0, len(patient_ids), MERGE_BATCH_SIZE):
+        batch_ids = patient_ids[i:i + MERGE_BATCH_SIZE]
+        session.sql(f'MERGE INTO {config.table_tensions_diseases} t USING ('
+                    f'SELECT t1.patient_id, t1.tensions, t2.diseases '
+                    f'FROM ({get_tensions_query(batch_ids)}) t1 '
+                    f'JOIN ('
+                    f'SELECT d.patient_id, '
+                    f'LISTAGG(d.disease_info_id, \',\') WITHIN GROUP (ORDER BY d.disease_info_id) AS diseases '
+                    f'FROM {config.dim_disease} d '
+                    f'WHERE d.patient_id IN ({get_id_list(batch_ids)}) GROUP BY d.patient_id) t2 '
+                    f'ON t1.patient_id = t2.patient_id) s '
+                    f'ON t.patient_id = s.patient_id '
+                    f'WHEN MATCHED THEN UPDATE SET tensions = s.tensions, diseases = s.diseases '
+                    f'WHEN NOT MATCHED THEN INSERT (patient_id, tensions, diseases) '
+                    f'VALUES (s.patient_id, s.tensions, s.diseases)').collect()
+    return len(patient_ids)
+
+
+def iterate_training_batches(get_batch, patient_ids, labels, batch_size, shuffle=False):
+    # Endless generator of (tensions, labels) batches, one pass over all patients per epoch
+    while True:
+        order = np.random.permutation(len(patient_ids)) if shuffle else np.arange(len(patient_ids))
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            yield signal_functions.preprocess_tensions(get_batch(patient_ids[batch])), labels[batch]
+
+
+def create_training_split(session, ids_train, ids_test):
+    # Table with the split of the patients, so an epoch reads the patients of its split with one join
+    session.sql(f'CREATE OR REPLACE TRANSIENT TABLE {config.table_training_split} ('
+                f'patient_id VARCHAR(7), '
+                f'split VARCHAR(5))').collect()
+    bulk_functions.insert_rows(session, config.table_training_split, ['patient_id', 'split'],
+                               [[patient_id, 'train'] for patient_id in ids_train] +
+                               [[patient_id, 'test'] for patient_id in ids_test])
+
+
+def iterate_table_batches(session, split, patient_ids, labels, batch_size, shuffle=False):
+    # Endless generator of (tensions, labels) batches. Every epoch streams the tensions of the split with one
+    # ordered query, chunks of TRAINING_CHUNK_SIZE patients are held in memory, shuffled and cut into batches.
+    positions = {patient_id: i for i, patient_id in enumerate(patient_ids)}
+    chunk_size = math.ceil(TRAINING_CHUNK_SIZE / batch_size) * batch_size
+    query = (f'SELECT t.patient_id, t.tensions FROM {config.table_tensions_diseases} t '
+             f'JOIN {config.table_training_split} s ON t.patient_id = s.patient_id '
+             f'WHERE s.split = \'{split}\' ORDER BY t.patient_id')
+    while True:
+        chunk_ids, chunk_tensions = [], []
+        for df in session.sql(query).to_pandas_batches():
+            chunk_ids.extend(df['PATIENT_ID'])
+            chunk_tensions.extend(df['TENSIONS'])
+            while len(chunk_ids) >= chunk_size:
+                yield from iterate_chunk_batches(chunk_ids[:chunk_size], chunk_tensions[:chunk_size], positions,
+                                                 labels, batch_size, shuffle)
+                del chunk_ids[:chunk_size], chunk_tensions[:chunk_size]
+        yield from iterate_chunk_batches(chunk_ids, chunk_tensions, positions, labels, batch_size, shuffle)
+
+
+def iterate_chunk_batches(chunk_ids, chunk_tensions, positions, labels, batch_size, shuffle):
+    order = np.random.permutation(len(chunk_ids)) if shuffle else np.arange(len(chunk_ids))
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        tensions = np.vstack([decode_tensions(chunk_tensions[i]) for i in batch])
+        yield (signal_functions.preprocess_tensions(tensions),
+               labels[[positions[chunk_ids[i]] for i in batch]])
+
+
+def get_store_functions():
+    # The local ECG store is not uploaded to Snowflake, so inside a stored procedure there is never a store
+    try:
+        import store_functions
+    except ImportError:
+        return None
+    return store_functions if store_functions.has_ecg_store() else None
+
+
+def get_store_training_tensions(patient_ids):
+    store_functions = get_store_functions()
+    if store_functions is None:
+        return None
+    store = store_functions.load_ecg_store()
+    if not store_functions.has_patients(store, patient_ids):
+        return None
+    return partial(store_functions.get_training_tensions, store)
+
+
+def get_patient_tensions(session, patient_ids):
+    # Get the tensions of many patients with one query, unknown patient ids are left out
+    return fetch_tensions(session, get_tensions_query(patient_ids), patient_ids)
+
+
+def fetch_tensions(session, query, patient_ids):
+    # Run a query returning (patient_id, tensions) rows and stack the tensions in the order of patient_ids
+    rows = session.sql(query).collect()
+    tensions = {row[0]: row[1] for row in rows}
+    found_ids = [patient_id for patient_id in patient_ids if patient_id in tensions]
+    if len(found_ids) == 0:
+        return found_ids, np.empty((0, NUM_TENSIONS), dtype=np.float32)
+    return found_ids, np.vstack([decode_tensions(tensions[patient_id]) for patient_id in found_ids])
+
+
+def get_id_list(patient_ids):
+    return ', '.join(f'\'{patient_id}\'' for patient_id in patient_ids)
 
 
-def predict(session, tensions):
-    # Convert the tensions string into a single row pandas dataframe
-    tensions = list(map(int, tensions.split(',')))
-    tensions = pd.DataFrame([tensions], columns=[i for i in range(0, 60000)])
+def decode_tensions(tensions):
+    # Tensions are int16 bytes in the wide layout and a comma separated string in the long layout
+    if isinstance(tensions, (bytes, bytearray)):
+        return np.frombuffer(tensions, dtype='<i2').astype(np.float32)
+    return np.fromstring(tensions, dtype=np.float32, sep=',')
 
+
+def encode_tensions_base64(tensions):
+    # Little-endian int16 bytes of the tensions as base64 text, about half the size of a comma separated string
+    return base64.b64encode(np.asarray(tensions).astype('<i2').tobytes()).decode('ascii')
+
+
+def decode_tensions_base64(tensions):
+    return np.frombuffer(base64.b64decode(tensions), dtype='<i2')
+
+
+def get_tensions_query(patient_ids=None):
+    # Query with one row (patient_id, tensions) per patient for the configured lead layout
+    if config.lead_layout == 'wide':
+        query = f'SELECT w.patient_id, w.tensions FROM {config.dim_lead_wide} w'
+        if patient_ids is not None:
+            query += f' WHERE w.patient_id IN ({get_id_list(patient_ids)})'
+        return query
+
+    query = (f'SELECT l.patient_id, '
+             f'LISTAGG(l.tension, \',\') WITHIN GROUP (ORDER BY l.timestamp) AS tensions '
+             f'FROM {config.dim_lead} l ')
+    if patient_ids is not None:
+        query += f'WHERE l.patient_id IN ({get_id_list(patient_ids)}) '
+    return query + 'GROUP BY l.patient_id'
+
+
+def predict(session, tensions, threshold=0.20):
+    # Convert the base64 int16 tensions into a single row array without parsing any text
+    tensions = decode_tensions_base64(tensions).reshape(1, NUM_TENSIONS)
+
+    # Load the model from the Snowflake stage, warm invocations reuse the loaded model
+    model_path = get_model_path()
+    model = get_model(model_path)
+    predictions = run_model(model, get_model_input(model, tensions))
+
+    # Convert predictions to disease full names
+    df = get_diagnoses(predictions, get_labels(session, model_path), threshold)
+
+    return df.drop(columns='ROW').to_json()
+
+
+def predict_patients(session, patient_ids, threshold=0.20):
+    # Get the tensions of all patients with one query and run the model once over the whole batch. Returns every
+    # requested patient_id with its list of diagnoses, which is empty without findings above the threshold, or
+    # null for a patient that was not found.
+    result = {patient_id: None for patient_id in patient_ids}
+    found_ids, tensions = get_patient_tensions(session, patient_ids)
+    if len(found_ids) == 0:
+        return json.dumps(result)
+
+    model_path = get_model_path()
+    model = get_model(model_path)
+    predictions = run_model(model, get_model_input(model, tensions))
+
+    # Convert predictions to disease full names per patient
+    df = get_diagnoses(predictions, get_labels(session, model_path), threshold)
+    result.update((patient_id, []) for patient_id in found_ids)
+    for row in df.itertuples(index=False):
+        result[found_ids[row.ROW]].append({'DISEASE_INFO_ID': int(row.DISEASE_INFO_ID), 'ACRONYM': row.ACRONYM,
+                                           'FULL_NAME': row.FULL_NAME, 'CONFIDENCE': float(row.CONFIDENCE)})
+
+    return json.dumps(result)
+
+
+def run_model(model, inputs):
+    # Calling the model directly skips the per-call setup of model.predict, which takes longer than the model
+    # itself for the few ECGs of a prediction
+    return model(inputs, training=False).numpy().astype('float64')
+
+
+def get_model_input(model, tensions):
+    # The same preprocessing as in training, models trained before it was added take the raw tensions
+    if model.input_shape[-1] == NUM_TENSIONS:
+        return tensions
+    return signal_functions.preprocess_tensions(tensions)
+
+
+def get_diagnoses(predictions, labels, threshold):
+    # Every (row, label) with a prediction above the threshold, labels without a disease are left out
+    rows, label_ids = np.nonzero(predictions > threshold)
+    df = labels.reindex(label_ids).reset_index(drop=True)
+    df.insert(0, 'ROW', rows)
+    df['CONFIDENCE'] = predictions[rows, label_ids]
+    df = df.dropna(subset=['DISEASE_INFO_ID']).reset_index(drop=True)
+    df['DISEASE_INFO_ID'] = df['DISEASE_INFO_ID'].astype('int64')
+    return df
+
+
+def get_labels(session, model_path):
+    # The label -> disease mapping is written together with the model, so it is cached per model version
+    version = get_model_version(model_path)
+    cached = label_cache.get(model_path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    labels = session.sql(f'SELECT ml.label_id, di.disease_info_id, di.acronym, di.full_name '
+                         f'FROM {config.table_model_labels} ml '
+                         f'JOIN {config.dim_disease_info} di '
+                         f'ON ml.disease_info_id = di.disease_info_id').to_pandas().set_index('LABEL_ID')
+    label_cache[model_path] = (version, labels)
+    return labels
+
+
+def get_model_path():
     # Get the path of the model from the Snowflake stage
     import_dir = sys._xoptions['snowflake_import_directory']
     model_file = 'my_model.h5'
-    model_path = import_dir + model_file
+    return import_dir + model_file
 
-    # Load the model from the Snowflake stage
-    model = load_model(model_path)
-    predictions = (model.predict(tensions.iloc[:1])).astype('float64')[0]
 
-    # Convert predictions to disease full names
-    df = pd.DataFrame(columns=['DISEASE_INFO_ID', 'ACRONYM', 'FULL_NAME'])
-    for i in range(1, predictions.size):
-        if predictions[i] > 0.20:
-            query = session.sql(f'SELECT di.disease_info_id, di.acronym, di.full_name '
-                                f'FROM {config.table_model_labels} ml '
-                                f'JOIN {config.dim_disease_info} di '
-                                f'ON ml.disease_info_id = di.disease_info_id '
-                                f'WHERE label_id = {i}')
-            data = query.to_pandas()
-            # data['PERCENTAGE'] = str(round((predictions[i] * 100).astype('float64'), 2)) + '%'
-            row = [df, data]
-            df = pd.concat(row, ignore_index=True)
-
-    return df.to_json()
-
-
-def predict_with_patient_id(session, patient_id):
-    # Get the tensions string from dim_lead for the patient_id
-    tensions = session.sql(f'SELECT LISTAGG(l.tension, \',\') WITHIN GROUP (ORDER BY l.timestamp) AS tensions '
-                           f'FROM {config.dim_lead} l '
-                           f'WHERE l.patient_id = \'{patient_id}\'').collect()[0][0]
+def get_model_version(model_path):
+    # The modification time and size identify the version of the model file
+    stat = os.stat(model_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def get_model(model_path):
+    version = get_model_version(model_path)
+    cached = model_cache.get(model_path)
+    if cached is not None and cached[0] == version:
+        model_cache_stats['hits'] += 1
+        return cached[1]
+
+    model_cache_stats['misses'] += 1
+    model = load_model(model_path, compile=False)
+    model_cache[model_path] = (version, model)
+    return model
+
+
+def get_model_cache_stats():
+    return {'hits': model_cache_stats['hits'], 'misses': model_cache_stats['misses'], 'models': len(model_cache)}
+
+
+def predict_with_patient_id(session, patient_id, threshold=0.20):
+    # Get the tensions of the patient_id as base64 int16 bytes, from the local ECG store while it holds the loaded
+    # records and has the patient
+    local_tensions = get_local_tensions(patient_id)
+    if local_tensions is not None:
+        tensions = encode_tensions_base64(local_tensions.ravel())
+    elif config.lead_layout == 'wide':
+        tensions = session.sql(f'SELECT BASE64_ENCODE(w.tensions) FROM {config.dim_lead_wide} w '
+                               f'WHERE w.patient_id = \'{patient_id}\'').collect()[0][0]
+    else:
+        # LISTAGG returns one row instead of pulling the 60000 rows of dim_lead to the client
+        tensions = session.sql(f'SELECT LISTAGG(l.tension, \',\') WITHIN GROUP (ORDER BY l.timestamp) AS tensions '
+                               f'FROM {config.dim_lead} l '
+                               f'WHERE l.patient_id = \'{patient_id}\'').collect()[0][0]
+        tensions = encode_tensions_base64(np.fromstring(tensions, dtype=np.int16, sep=','))
 
     # Call the predict stored procedure
-    predictions = session.sql(f'CALL predict(\'{tensions}\')').collect()[0][0]
+    predictions = session.sql(f'CALL predict(\'{tensions}\', {threshold})').collect()[0][0]
 
-    json = eval(predictions)
+    result = json.loads(predictions)
 
-    df = pd.DataFrame(columns=['SNOMED CT', 'Acronym', 'Full name'])
-    for disease_info_id in json['DISEASE_INFO_ID']:
-        df.loc[len(df.index)] = [json['DISEASE_INFO_ID'][disease_info_id], json['ACRONYM'][disease_info_id],
-                                 json['FULL_NAME'][disease_info_id]]
+    df = pd.DataFrame(columns=['SNOMED CT', 'Acronym', 'Full name', 'Confidence'])
+    for disease_info_id in result['DISEASE_INFO_ID']:
+        df.loc[len(df.index)] = [result['DISEASE_INFO_ID'][disease_info_id], result['ACRONYM'][disease_info_id],
+                                 result['FULL_NAME'][disease_info_id], result['CONFIDENCE'][disease_info_id]]
 
     return df
+
+
+def get_local_tensions(patient_id):
+    store_functions = get_store_functions()
+    return None if store_functions is None else store_functions.get_local_ecg(patient_id)
+
+
+def predict_batch(session, patient_ids, threshold=0.20):
+    # Diagnoses of many patients: patient_id -> DataFrame like the one of predict_with_patient_id for every
+    # requested patient. The DataFrame is empty without findings above the threshold, and None for a patient
+    # that was not found.
+    if len(patient_ids) == 0:
+        return {}
+
+    # Call the predict_patients stored procedure once for all patients
+    predictions = session.sql(f'CALL predict_patients(ARRAY_CONSTRUCT({get_id_list(patient_ids)}), '
+                              f'{threshold})').collect()[0][0]
+
+    result = {}
+    for patient_id, diagnoses in json.loads(predictions).items():
+        if diagnoses is None:
+            result[patient_id] = None
+        else:
+            result[patient_id] = pd.DataFrame(
+                [[row['DISEASE_INFO_ID'], row['ACRONYM'], row['FULL_NAME'], row['CONFIDENCE']] for row in diagnoses],
+                columns=['SNOMED CT', 'Acronym', 'Full name', 'Confidence'])
+    return result
@@ -0,0 +1,94 @@
+import json
+import re
+
+import config
+import model_functions
+import snowflake_functions
+
+# Number of patients whose lookups are measured, spread evenly over the patient_id range
+NUM_SAMPLE_PATIENTS = 5
+
+# Number of patients in the batch lookup, like a batch of predict_batch
+BATCH_SIZE = 32
+
+
+def get_sample_patient_ids(session, num_patients=NUM_SAMPLE_PATIENTS):
+    patient_ids = [row[0] for row in session.sql(f'SELECT patient_id FROM {config.fact_patient} '
+                                                 f'ORDER BY patient_id').collect()]
+    if len(patient_ids) <= num_patients:
+        return patient_ids
+    step = (len(patient_ids) - 1) / (num_patients - 1)
+    return [patient_ids[round(i * step)] for i in range(num_patients)]
+
+
+def get_patient_query(patient_id):
+    # The lookup of get_tensions and predict_with_patient_id
+    if config.lead_layout == 'wide':
+        return f'SELECT tensions FROM {config.dim_lead_wide} WHERE patient_id = \'{patient_id}\''
+    return f'SELECT l.tension FROM {config.dim_lead} AS l WHERE patient_id = \'{patient_id}\' ORDER BY l.timestamp'
+
+
+def get_partitions_scanned(session, query, patient_ids):
+    # (partitions scanned, partitions in total) of a query that filters on patient_ids
+    if config.backend == 'local':
+        return get_row_groups_scanned(session, patient_ids)
+
+    session.sql(query).collect()
+    query_id = session.sql('SELECT LAST_QUERY_ID()').collect()[0][0]
+    rows = session.sql(f'SELECT operator_statistics:pruning:partitions_scanned::NUMBER, '
+                       f'operator_statistics:pruning:partitions_total::NUMBER '
+                       f'FROM TABLE(GET_QUERY_OPERATOR_STATS(\'{query_id}\')) '
+                       f'WHERE operator_type = \'TableScan\'').collect()
+    return sum(int(row[0] or 0) for row in rows), sum(int(row[1] or 0) for row in rows)
+
+
+def get_row_groups_scanned(session, patient_ids):
+    # DuckDB skips the row groups whose min/max of patient_id can not hold the patient, the local
+    # counterpart of the pruning of micro-partitions
+    table = config.dim_lead_wide if config.lead_layout == 'wide' else config.dim_lead
+    rows = session.sql(f'SELECT row_group_id, stats FROM pragma_storage_info(\'{table}\') '
+                       f'WHERE column_name = \'patient_id\'').collect()
+    ranges = {}
+    for row_group_id, stats in rows:
+        match = re.search(r'Min: ([^,\]]+), Max: ([^,\]]+)', stats)
+        if match is None:
+            continue
+        low, high = ranges.get(row_group_id, match.groups())
+        ranges[row_group_id] = (min(low, match.group(1)), max(high, match.group(2)))
+
+    scanned = sum(any(low <= patient_id <= high for patient_id in patient_ids) for low, high in ranges.values())
+    return scanned, len(ranges)
+
+
+def print_clustering_information(session):
+    if config.backend == 'local':
+        return
+    table, key = ((config.dim_lead_wide, 'patient_id') if config.lead_layout == 'wide'
+                  else (config.dim_lead, 'patient_id, timestamp'))
+    information = json.loads(session.sql(f'SELECT SYSTEM$CLUSTERING_INFORMATION(\'{table}\', '
+                                         f'\'({key})\')').collect()[0][0])
+    print(f'{table} clustered by ({key}): {information["total_partition_count"]} partitions, '
+          f'average depth {information["average_depth"]}')
+
+
+def print_partition_report(session):
+    # Partitions scanned by the per-patient lookups, they should stay the same as the table grows
+    print_clustering_information(session)
+
+    patient_ids = get_sample_patient_ids(session)
+    for patient_id in patient_ids:
+        scanned, total = get_partitions_scanned(session, get_patient_query(patient_id), [patient_id])
+        print(f'Tensions of {patient_id}: {scanned} of {total} partitions scanned')
+
+    batch_ids = get_sample_patient_ids(session, BATCH_SIZE)
+    scanned, total = get_partitions_scanned(session, model_functions.get_tensions_query(batch_ids), batch_ids)
+    print(f'Tensions of a batch of {len(batch_ids)} patients: {scanned} of {total} partitions scanned')
+
+
+if __name__ == "__main__":
+    session = snowflake_functions.get_session(initialize=False)
+
+    # Results served from the result cache do not scan anything
+    session.sql('ALTER SESSION SET USE_CACHED_RESULT = FALSE').collect()
+
+    print_partition_report(session)
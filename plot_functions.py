@@ -0,0 +1,56 @@
+import io
+
+import matplotlib
+
+matplotlib.use('Agg')
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+# Names of the 12 leads in the order of the rows of a .mat file
+LEAD_NAMES = ['I', 'II', 'III', 'aVR', 'aVL', 'aVF', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6']
+
+# Size of the 12-lead grid image: 4 columns of 3 leads, like the four columns of the Analyse tab
+PLOT_WIDTH_PIXELS = 1600
+PLOT_HEIGHT_PIXELS = 600
+PLOT_DPI = 100
+
+
+def downsample_min_max(lead, num_buckets):
+    # Keep the minimum and maximum of every bucket of samples, in the order they occur. A line through these
+    # points looks the same as the full lead when there is one bucket per pixel column.
+    lead = np.asarray(lead)
+    if len(lead) <= 2 * num_buckets:
+        return np.arange(len(lead)), lead
+
+    # Equal buckets as rows of a matrix, the last bucket is padded with the last sample
+    bucket_size = -(-len(lead) // num_buckets)
+    buckets = np.pad(lead, (0, bucket_size * num_buckets - len(lead)), mode='edge').reshape(num_buckets, bucket_size)
+    x = np.sort(np.stack([buckets.argmin(axis=1), buckets.argmax(axis=1)], axis=1), axis=1)
+    x = np.minimum((x + np.arange(num_buckets)[:, None] * bucket_size).ravel(), len(lead) - 1)
+    return x, lead[x]
+
+
+def render_ecg_grid(time_series, width=PLOT_WIDTH_PIXELS, height=PLOT_HEIGHT_PIXELS, dpi=PLOT_DPI):
+    # PNG image of the 12 leads, every lead downsampled to the pixel width of its plot
+    figure, axes = plt.subplots(3, 4, figsize=(width / dpi, height / dpi), dpi=dpi, sharex=True,
+                                gridspec_kw={'left': 0.04, 'right': 0.99, 'bottom': 0.05, 'top': 0.95,
+                                             'wspace': 0.15, 'hspace': 0.25})
+    try:
+        num_buckets = max(1, width // 4)
+        for i, lead in enumerate(np.asarray(time_series)[:12]):
+            ax = axes[i % 3][i // 3]
+            ax.plot(*downsample_min_max(lead, num_buckets), linewidth=0.6)
+            ax.set_title(LEAD_NAMES[i], fontsize=8, loc='left')
+            ax.tick_params(labelsize=6)
+
+            # Fixed ticks and margins, working out a tight layout costs more than drawing the leads
+            ax.set_xticks(np.arange(0, len(lead) + 1, 1000))
+            ax.set_yticks(np.linspace(lead.min(), lead.max(), 3).round())
+
+        buffer = io.BytesIO()
+        figure.savefig(buffer, format='png')
+        return buffer.getvalue()
+    finally:
+        # Figures are kept by pyplot until they are closed
+        plt.close(figure)
@@ -0,0 +1,151 @@
+import inspect
+import sys
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+import numpy as np
+import pandas as pd
+
+import config
+
+
+# Least recently used cache of query results with a time to live, bounded by the estimated size of the results.
+# Every entry has tags, e.g. ('patient', 'JS00013'), so a write can invalidate exactly the results it changes.
+class QueryCache:
+    def __init__(self, max_bytes=config.query_cache_max_bytes, ttl=config.query_cache_ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        # key -> (expires at, size, tags, value), the least recently used entry first
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.num_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def get(self, key):
+        # Returns (True, value) for a cached result and (False, None) otherwise
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self.remove(key)
+                self.stats['expirations'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return True, entry[3]
+
+    def put(self, key, value, tags=(), ttl=None):
+        tags = [make_hashable(tag) for tag in tags]
+        size = get_size(value)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), size, tuple(tags), value)
+            self.num_bytes += size
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+
+            # Drop the least recently used results until the cache fits again
+            while self.num_bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+
+    def invalidate(self, *tags):
+        with self.lock:
+            for tag in tags:
+                for key in list(self.tags.get(make_hashable(tag), ())):
+                    self.remove(key)
+                    self.stats['invalidations'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+            self.num_bytes = 0
+
+    def remove(self, key):
+        # Called with the lock held
+        _, size, tags, _ = self.entries.pop(key)
+        self.num_bytes -= size
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+            stats['bytes'] = self.num_bytes
+        stats['hit_rate'] = stats['hits'] / max(1, stats['hits'] + stats['misses'])
+        return stats
+
+
+# Process-wide cache of the read functions of snowflake_functions
+cache = QueryCache()
+
+
+def cached(get_tags, ttl=None):
+    # Decorator that caches the result of a read function per function and arguments. The session argument is
+    # not part of the key, every session reads the same warehouse. get_tags is called with the same arguments
+    # and returns the tags of the result. Cached results are shared, callers must not modify them.
+    def decorator(function):
+        parameters = list(inspect.signature(function).parameters)
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            arguments = dict(zip(parameters, args), **kwargs)
+            arguments.pop('session', None)
+            key = (function.__name__,) + tuple(sorted((name, make_hashable(value)) for name, value in arguments.items()))
+
+            found, value = cache.get(key)
+            if not found:
+                value = function(*args, **kwargs)
+                cache.put(key, value, get_tags(**arguments), ttl)
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+def invalidate(*tags):
+    cache.invalidate(*tags)
+
+
+def clear():
+    cache.clear()
+
+
+def get_stats():
+    return cache.get_stats()
+
+
+def make_hashable(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(make_hashable(item) for item in value)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def get_size(value):
+    # Estimated number of bytes a result keeps in memory
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(get_size(item) for item in value)
+    return sys.getsizeof(value)
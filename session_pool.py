@@ -0,0 +1,174 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+
+
+# Process-wide pool of sessions. Callers borrow a session for one piece of work and give it back, so a few
+# connections serve every browser session of the app instead of one connection per browser session.
+class SessionPool:
+    def __init__(self, create_session, size=config.session_pool_size, idle_timeout=config.session_idle_timeout,
+                 health_check_interval=config.session_health_check_interval):
+        self.create_session = create_session
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+
+        # Idle sessions as [session, time it was released] pairs, the most recently released one last
+        self.idle = []
+        self.num_open = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+        self.metrics = {
+            'acquired': 0,
+            'waited': 0,
+            'created': 0,
+            'evicted': 0,
+            'failed_health_checks': 0,
+            'acquire_seconds': 0.0,
+            'max_acquire_seconds': 0.0,
+            'borrowed_seconds': 0.0
+        }
+        self.borrowed = {}
+
+    @contextmanager
+    def session(self, timeout=None):
+        # with pool.session() as session: ... borrows a session for the duration of the block
+        s = self.acquire(timeout)
+        broken = False
+        try:
+            yield s
+        except Exception:
+            # The error may have left the connection unusable, a health check decides before it is used again
+            broken = True
+            raise
+        finally:
+            self.release(s, check=broken)
+
+    def acquire(self, timeout=None):
+        start = time.perf_counter()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waited = False
+
+        while True:
+            with self.condition:
+                if self.closed:
+                    raise RuntimeError('The session pool is closed')
+                self.evict_idle()
+
+                if self.idle:
+                    s, released_at = self.idle.pop()
+                    create = False
+                elif self.num_open < self.size:
+                    # Reserve a place in the pool, the session is created outside of the lock
+                    self.num_open += 1
+                    s, released_at, create = None, None, True
+                else:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(f'No session became available within {timeout} seconds')
+                    waited = True
+                    self.condition.wait(remaining)
+                    continue
+
+            if create:
+                s = self.create_new_session()
+            elif time.monotonic() - released_at > self.health_check_interval and not self.is_healthy(s):
+                # A session that was idle for a while may have been closed by the server
+                self.discard(s)
+                continue
+
+            self.record_acquire(s, time.perf_counter() - start, waited)
+            return s
+
+    def release(self, s, check=False):
+        with self.condition:
+            borrowed_at = self.borrowed.pop(id(s), None)
+            if borrowed_at is not None:
+                self.metrics['borrowed_seconds'] += time.perf_counter() - borrowed_at
+
+        if self.closed or (check and not self.is_healthy(s)):
+            self.discard(s)
+            return
+
+        with self.condition:
+            self.idle.append([s, time.monotonic()])
+            self.condition.notify()
+
+    def create_new_session(self):
+        try:
+            s = self.create_session()
+        except Exception:
+            # Give the reserved place back, so a failed connect does not shrink the pool
+            with self.condition:
+                self.num_open -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.metrics['created'] += 1
+        return s
+
+    def is_healthy(self, s):
+        try:
+            s.sql('SELECT 1').collect()
+            return True
+        except Exception:
+            with self.condition:
+                self.metrics['failed_health_checks'] += 1
+            return False
+
+    def discard(self, s):
+        with self.condition:
+            self.num_open -= 1
+            self.condition.notify()
+        close_session(s)
+
+    def evict_idle(self):
+        # Close the sessions that were idle for longer than idle_timeout, called with the lock held
+        now = time.monotonic()
+        expired = [item for item in self.idle if now - item[1] > self.idle_timeout]
+        if not expired:
+            return
+        self.idle = [item for item in self.idle if now - item[1] <= self.idle_timeout]
+        self.num_open -= len(expired)
+        self.metrics['evicted'] += len(expired)
+        for s, _ in expired:
+            close_session(s)
+
+    def record_acquire(self, s, seconds, waited):
+        with self.condition:
+            self.borrowed[id(s)] = time.perf_counter()
+            self.metrics['acquired'] += 1
+            self.metrics['waited'] += waited
+            self.metrics['acquire_seconds'] += seconds
+            self.metrics['max_acquire_seconds'] = max(self.metrics['max_acquire_seconds'], seconds)
+
+    def get_metrics(self):
+        # Counters of the pool, with the average time to acquire and the average time a session was borrowed
+        with self.condition:
+            metrics = dict(self.metrics)
+            metrics['open'] = self.num_open
+            metrics['idle'] = len(self.idle)
+            metrics['in_use'] = len(self.borrowed)
+        metrics['average_acquire_seconds'] = metrics['acquire_seconds'] / max(1, metrics['acquired'])
+        metrics['average_borrowed_seconds'] = metrics['borrowed_seconds'] / max(1, metrics['acquired'] - metrics['in_use'])
+        return metrics
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.num_open -= len(idle)
+            self.condition.notify_all()
+        for s, _ in idle:
+            close_session(s)
+
+
+def close_session(s):
+    # A session that is closed already, or whose connection is gone, can not be closed again
+    try:
+        s.close()
+    except Exception:
+        pass
@@ -0,0 +1,40 @@
+import math
+from functools import lru_cache
+
+import numpy as np
+from scipy.signal import butter, sosfiltfilt
+
+import config
+
+# Shape of the raw tensions of one ECG: 12 leads of 5000 samples
+NUM_LEADS = 12
+NUM_SAMPLES = 5000
+
+
+def preprocess_tensions(tensions):
+    # Raw tensions of n ECGs, as (n, 60000) or (n, 12, 5000), to (n, num_features) float32 model input.
+    # All leads of all ECGs are filtered with one call along the time axis.
+    tensions = np.asarray(tensions, dtype=np.float32).reshape(-1, NUM_LEADS, NUM_SAMPLES)
+    if len(tensions) == 0:
+        return np.empty((0, get_num_features()), dtype=np.float32)
+
+    # The band-pass filter removes baseline wander and the frequencies above signal_high_cut, then every
+    # signal_decimation-th sample is kept. The filter is not ideal, so what it leaves above the Nyquist frequency
+    # of the decimated leads folds back. With the defaults (order 4, applied forwards and backwards, 125 Hz after
+    # decimation) that is over 30 dB down at 62.5 Hz, and what folds below 40 Hz is down by about 50 dB.
+    filtered = sosfiltfilt(get_band_pass_filter(), tensions, axis=-1)[..., ::config.signal_decimation]
+
+    # Standardize every lead, a flat lead stays zero
+    filtered -= filtered.mean(axis=-1, keepdims=True)
+    filtered /= filtered.std(axis=-1, keepdims=True) + 1e-6
+    return filtered.reshape(len(tensions), -1).astype(np.float32)
+
+
+@lru_cache(maxsize=1)
+def get_band_pass_filter():
+    return butter(config.signal_filter_order, [config.signal_low_cut, config.signal_high_cut], btype='bandpass',
+                  fs=config.signal_sample_rate, output='sos')
+
+
+def get_num_features():
+    return NUM_LEADS * math.ceil(NUM_SAMPLES / config.signal_decimation)
@@ -1,30 +1,63 @@
+import csv
+import hashlib
+import os
+import tempfile
+import uuid
 from datetime import datetime
+from pathlib import Path
+
+import numpy as np
 from snowflake.snowpark.session import Session
+import bulk_functions
 import config
+import local_functions
+import model_functions
+import query_cache
+import store_functions
 
 # URL to locate package concerning all the files around our project
 # This package has to be on the same level as the project directory
 BASE_PATH = '.\\..\\a-large-scale-12-lead-electrocardiogram-database-for-arrhythmia-study-1.0.0\\'
 
+# Manifest of the uploaded files: how many bytes and records of every local file are on its stage,
+# in how many parts they were uploaded and which patients they hold
+UPLOAD_MANIFEST_PATH = 'manifest/uploads.csv'
+UPLOAD_MANIFEST_HEADER = ['STAGE', 'FILE', 'SIZE', 'MTIME', 'OFFSET', 'PART', 'NUM_RECORDS', 'RECORDS_MD5',
+                          'PATIENT_IDS']
+
+# Directory for the parts of the local files that are not uploaded yet
+DELTA_DIRECTORY = 'csv_files/delta/'
+
+# Prefix on the csv stage for the batches of uploaded ECGs, every batch gets its own directory below it
+INGEST_PREFIX = 'ingest/'
+
 
 def get_session(initialize):
+    s = create_session()
+
+    if initialize:
+        initialize_session(s)
+
+    return s
+
+
+def create_session():
+    # The warehouse, database and schema are set when connecting, so a new session needs no USE statements
     connection_parameters = {
         'account': config.account,
         'user': config.user,
         'password': config.password,
         'role': config.role,
         'warehouse': config.warehouse,
+        'database': config.database,
         'schema': config.schema
     }
 
-    s = Session.builder.configs(connection_parameters).create()
-
-    if initialize:
-        initialize_session(s)
-    else:
-        use_session(s)
-
-    return s
+    if config.backend == 'local':
+        # duckdb is only needed by the local backend
+        from local_session import LocalSession
+        return LocalSession()
+    return Session.builder.configs(connection_parameters).create()
 
 
 def initialize_session(session):
@@ -49,6 +82,11 @@ def initialize_session(session):
                                   config.csv_stage)
     create_stage_with_format_type(session, config.csv_format, 'CSV SKIP_HEADER = 1 COMPRESSION = GZIP',
                                   config.csv_stage_lead)
+    create_stage_with_format_type(session, config.csv_format, 'CSV SKIP_HEADER = 1 COMPRESSION = GZIP',
+                                  config.csv_stage_lead_wide)
+
+    # Create stage with a parquet file format for the dim_lead_*.parquet files
+    create_stage_with_format_type(session, config.parquet_format, 'PARQUET', config.parquet_stage_lead)
 
 
 def create_stage(session, stage_name):
@@ -63,80 +101,130 @@ def create_stage_with_format_type(session, format_name, format_type, stage_name)
                 f'FILE_FORMAT = {format_name}').collect()
 
 
-def use_session(session):
-    session.sql(f'USE WAREHOUSE {config.warehouse}').collect()
-
-    session.sql(f'USE DATABASE {config.database}').collect()
-
-    session.sql(f'USE SCHEMA {config.schema}').collect()
-
-
 def use_warehouse(session, warehouse_name):
     session.sql(f'USE WAREHOUSE {warehouse_name}').collect()
 
 
-def process_csv_files(upload, create_tables, copy, session):
+def process_csv_files(upload, create_tables, copy, session, format='csv', incremental=False):
+    if upload or create_tables or copy:
+        # While the tables change, the tensions are read from the warehouse instead of the local ECG store
+        store_functions.forget_ecg_store_load()
+
     if upload:
-        # Upload the csv-files to stages on Snowflake
-        upload_all_files(session)
+        # Upload the csv-files to stages on Snowflake, incrementally only the parts that are not uploaded yet
+        if incremental:
+            upload_changed_files(session, format)
+        else:
+            upload_all_files(session, format)
 
     if create_tables:
-        # Create the tables on Snowflake
-        create_all_tables(session)
+        # Create the tables on Snowflake, an incremental load keeps the existing tables
+        create_all_tables(session, replace=not incremental)
 
     if copy:
         # Copy csv-files into tables using SnowSQL-commands
-        copy_all_files_into_tables(session)
+        copy_all_files_into_tables(session, format)
+
+        # Aggregate the training features of the patients that were loaded, so training does not have to
+        start_time = datetime.now()
+        num_patients = model_functions.merge_training_features(session)
+        print(f'Aggregated the training features of {num_patients} patients in {datetime.now() - start_time}')
+
+        # The local ECG store is used again when it holds exactly the records that were loaded
+        if store_functions.mark_ecg_store_loaded(get_loaded_records(format)):
+            print('The local ECG store holds the loaded records')
+
+    if create_tables or copy:
+        # New patients get the ids after the loaded patients
+        create_patient_id_sequence(session)
+
+        # Cached query results of this process may be of the old tables
+        query_cache.clear()
 
 
 def upload_py_files(upload, session):
     if upload:
         upload_import_file(session, 'model_functions.py', config.functions_stage)
+        upload_import_file(session, 'bulk_functions.py', config.functions_stage)
+        upload_import_file(session, 'signal_functions.py', config.functions_stage)
         upload_import_file(session, 'config.py', config.functions_stage)
 
 
-def create_all_tables(session):
-    create_fact_patient_table(session)
-    create_dim_disease_info_table(session)
-    create_dim_disease(session)
-    create_dim_lead_table(session)
-    create_table_user(session)
-    create_table_patient_user(session)
+def create_all_tables(session, replace=True):
+    # Without replace, existing tables and their data are kept for an incremental load
+    create_fact_patient_table(session, replace)
+    create_dim_disease_info_table(session, replace)
+    create_dim_disease(session, replace)
+    create_dim_lead_table(session, replace)
+    create_dim_lead_wide_table(session, replace)
+    create_table_user(session, replace)
+    create_table_patient_user(session, replace)
+    model_functions.create_training_table(session, replace)
 
 
-def create_fact_patient_table(session):
-    session.sql(f'CREATE OR REPLACE TABLE {config.fact_patient} ('
+def get_create_table(replace, table_type='TABLE'):
+    return f'CREATE OR REPLACE {table_type}' if replace else f'CREATE {table_type} IF NOT EXISTS'
+
+
+def create_fact_patient_table(session, replace=True):
+    session.sql(f'{get_create_table(replace)} {config.fact_patient} ('
                 f'patient_id VARCHAR(7) PRIMARY KEY, '
                 f'age NUMBER(3, 0), '
                 f'gender VARCHAR(1))').collect()
 
 
-def create_dim_disease(session):
+def create_dim_disease(session, replace=True):
     session.sql(
-        f'CREATE OR REPLACE TABLE {config.dim_disease} ('
+        f'{get_create_table(replace)} {config.dim_disease} ('
         f'patient_id VARCHAR(7) REFERENCES {config.fact_patient} (patient_id), '
         f'disease_info_id NUMBER(9, 0) REFERENCES {config.dim_disease_info} (disease_info_id))').collect()
 
 
-def create_dim_disease_info_table(session):
+def create_dim_disease_info_table(session, replace=True):
     session.sql(
-        f'CREATE OR REPLACE TABLE {config.dim_disease_info} ('
+        f'{get_create_table(replace)} {config.dim_disease_info} ('
         f'acronym VARCHAR(7), '
         f'full_name VARCHAR(50), '
         f'disease_info_id NUMBER(9, 0) PRIMARY KEY)').collect()
 
 
-def create_dim_lead_table(session):
+def create_dim_lead_table(session, replace=True):
     session.sql(
-        f'CREATE OR REPLACE TABLE {config.dim_lead} ('
+        f'{get_create_table(replace)} {config.dim_lead} ('
         f'patient_id VARCHAR(7) REFERENCES {config.fact_patient} (patient_id), '
         f'timestamp NUMBER(5, 0), '
         f'tension NUMBER(5, 0))').collect()
+    set_lead_table_layout(session, config.dim_lead, 'patient_id, timestamp')
+
+    # Transient table the lead files are copied into before they are inserted in patient order. It is only
+    # replaced together with dim_lead, its load history keeps track of the files that are loaded already.
+    session.sql(
+        f'{get_create_table(replace, "TRANSIENT TABLE")} {config.dim_lead_staging} ('
+        f'patient_id VARCHAR(7), '
+        f'timestamp NUMBER(5, 0), '
+        f'tension NUMBER(5, 0))').collect()
+
 
+def create_dim_lead_wide_table(session, replace=True):
+    # One row per patient, the 12x5000 tensions are stored as 120000 bytes of little-endian int16
+    session.sql(
+        f'{get_create_table(replace)} {config.dim_lead_wide} ('
+        f'patient_id VARCHAR(7) REFERENCES {config.fact_patient} (patient_id), '
+        f'tensions BINARY)').collect()
+    set_lead_table_layout(session, config.dim_lead_wide, 'patient_id')
+
+
+def set_lead_table_layout(session, table, clustering_key):
+    # Lookups of a patient only read the micro-partitions with its rows instead of the whole table
+    if config.dim_lead_clustering:
+        session.sql(f'ALTER TABLE {table} CLUSTER BY ({clustering_key})').collect()
+    if config.dim_lead_search_optimization:
+        session.sql(f'ALTER TABLE {table} ADD SEARCH OPTIMIZATION ON EQUALITY(patient_id)').collect()
 
-def create_table_user(session):
+
+def create_table_user(session, replace=True):
     session.sql(
-        f'CREATE OR REPLACE TABLE {config.table_user} ('
+        f'{get_create_table(replace)} {config.table_user} ('
         f'user_id NUMBER NOT NULL AUTOINCREMENT START 1 INCREMENT 1 PRIMARY KEY, '
         f'firstname VARCHAR, '
         f'lastname VARCHAR, '
@@ -144,20 +232,34 @@ def create_table_user(session):
         f'password VARCHAR)').collect()
 
 
-def create_table_patient_user(session):
+def create_table_patient_user(session, replace=True):
     session.sql(
-        f'CREATE OR REPLACE TABLE {config.table_patient_user} ('
+        f'{get_create_table(replace)} {config.table_patient_user} ('
         f'patient_id VARCHAR(7) REFERENCES {config.fact_patient} (patient_id), '
         f'user_id NUMBER REFERENCES {config.table_user} (user_id))'
     ).collect()
 
 
-def upload_all_files(session):
+def create_patient_id_sequence(session):
+    # New patients get ids after the loaded patients and after the records of the local ECG store, so an
+    # uploaded ECG never gets the id of a record that is not loaded yet
+    max_ids = [session.sql(f'SELECT MAX(patient_id) FROM {config.fact_patient}').collect()[0][0],
+               store_functions.get_max_patient_id()]
+    start = max([int(max_id[2:]) for max_id in max_ids if max_id is not None], default=0) + 1
+    session.sql(f'CREATE OR REPLACE SEQUENCE {config.patient_id_sequence} START WITH {start} INCREMENT BY 1').collect()
+
+
+def upload_all_files(session, format='csv'):
+    # The parts of earlier incremental uploads are replaced by the complete files
+    remove_staged_deltas(session, get_lead_stage(format))
+    remove_staged_deltas(session, config.csv_stage)
+
     sql_statement = (
         f'PUT file://C:{BASE_PATH}ConditionNames_SNOMED-CT.csv '
         f'@{config.csv_stage} '
         f'AUTO_COMPRESS = TRUE '
-        f'SOURCE_COMPRESSION = NONE')
+        f'SOURCE_COMPRESSION = NONE '
+        f'OVERWRITE = TRUE')
 
     execute_sql_statement_with_message(session, sql_statement, "Uploaded ConditionNames_SNOMED-CT.csv")
 
@@ -165,7 +267,8 @@ def upload_all_files(session):
         f'PUT file://C:csv_files\\fact_patient.csv '
         f'@{config.csv_stage} '
         f'AUTO_COMPRESS = TRUE '
-        f'SOURCE_COMPRESSION = NONE')
+        f'SOURCE_COMPRESSION = NONE '
+        f'OVERWRITE = TRUE')
 
     execute_sql_statement_with_message(session, sql_statement, "Uploaded fact_patient.csv")
 
@@ -173,16 +276,34 @@ def upload_all_files(session):
         f'PUT file://C:csv_files\\dim_disease.csv '
         f'@{config.csv_stage} '
         f'AUTO_COMPRESS = TRUE '
-        f'SOURCE_COMPRESSION = NONE')
+        f'SOURCE_COMPRESSION = NONE '
+        f'OVERWRITE = TRUE')
 
     execute_sql_statement_with_message(session, sql_statement, "Uploaded dim_disease.csv")
 
+    if format == 'parquet':
+        upload_all_parquet_lead_files(session)
+    elif format == 'wide':
+        upload_all_wide_lead_files(session)
+    else:
+        upload_all_csv_lead_files(session)
+
+    # Remember what is on the stages for the next incremental upload
+    uploads = {}
+    for stage, file_path, table, output_path, offset_index in get_upload_files(format):
+        records = local_functions.read_manifest(output_path) if output_path else None
+        uploads[(stage, file_path)] = get_upload(stage, file_path, records, offset_index, 0)
+    write_upload_manifest(uploads)
+
+
+def upload_all_csv_lead_files(session):
     sql_statement = (
         f'PUT file://C:csv_files\\dim_lead\\dim_lead_0*.csv '
         f'@{config.csv_stage_lead} '
         f'PARALLEL = 50 '
         f'AUTO_COMPRESS = TRUE '
-        f'SOURCE_COMPRESSION = NONE')
+        f'SOURCE_COMPRESSION = NONE '
+        f'OVERWRITE = TRUE')
 
     execute_sql_statement_with_message(session, sql_statement, "Uploaded dim_lead_0*.csv")
 
@@ -191,7 +312,8 @@ def upload_all_files(session):
         f'@{config.csv_stage_lead} '
         f'PARALLEL = 50 '
         f'AUTO_COMPRESS = TRUE '
-        f'SOURCE_COMPRESSION = NONE')
+        f'SOURCE_COMPRESSION = NONE '
+        f'OVERWRITE = TRUE')
 
     execute_sql_statement_with_message(session, sql_statement, "Uploaded dim_lead_1*.csv")
 
@@ -200,11 +322,210 @@ def upload_all_files(session):
         f'@{config.csv_stage_lead} '
         f'PARALLEL = 56 '
         f'AUTO_COMPRESS = TRUE '
-        f'SOURCE_COMPRESSION = NONE')
+        f'SOURCE_COMPRESSION = NONE '
+        f'OVERWRITE = TRUE')
 
     execute_sql_statement_with_message(session, sql_statement, "Uploaded dim_lead_2*.csv")
 
 
+def upload_all_parquet_lead_files(session):
+    for prefix, parallel in [('0', 50), ('1', 50), ('2', 56)]:
+        sql_statement = (
+            f'PUT file://C:parquet_files\\dim_lead\\dim_lead_{prefix}*.parquet '
+            f'@{config.parquet_stage_lead} '
+            f'PARALLEL = {parallel} '
+            f'AUTO_COMPRESS = FALSE '
+            f'SOURCE_COMPRESSION = NONE '
+            f'OVERWRITE = TRUE')
+
+        execute_sql_statement_with_message(session, sql_statement, f'Uploaded dim_lead_{prefix}*.parquet')
+
+
+def upload_all_wide_lead_files(session):
+    sql_statement = (
+        f'PUT file://C:csv_files\\dim_lead_wide\\dim_lead_wide_*.csv '
+        f'@{config.csv_stage_lead_wide} '
+        f'PARALLEL = 50 '
+        f'AUTO_COMPRESS = TRUE '
+        f'SOURCE_COMPRESSION = NONE '
+        f'OVERWRITE = TRUE')
+
+    execute_sql_statement_with_message(session, sql_statement, "Uploaded dim_lead_wide_*.csv")
+
+
+def upload_changed_files(session, format='csv'):
+    # Only upload what changed since the last upload: the new rows that were appended to a file are uploaded
+    # as a separate part, a file that was rewritten is uploaded again after its old rows are deleted
+    Path(DELTA_DIRECTORY).mkdir(parents=True, exist_ok=True)
+    uploads = read_upload_manifest()
+
+    # The training features of the patients whose rows are replaced are deleted together with their rows
+    model_functions.create_training_table(session)
+    num_unchanged = 0
+
+    for stage, file_path, table, output_path, offset_index in get_upload_files(format):
+        upload = uploads.get((stage, file_path))
+        stat = os.stat(file_path)
+        if upload is not None and (upload[0], upload[1]) == (stat.st_size, stat.st_mtime_ns):
+            num_unchanged += 1
+            continue
+
+        records = local_functions.read_manifest(output_path) if output_path else None
+        delta_offset = get_delta_offset(upload, records, offset_index, not file_path.endswith('.parquet'))
+        if delta_offset is None:
+            # Rewritten (or never uploaded): replace the file and everything loaded from it
+            if upload is not None:
+                delete_loaded_rows(session, table, upload[6] if output_path else None)
+            remove_staged_deltas(session, stage, file_path)
+            put_file(session, file_path, stage, stat.st_size)
+            part = 0
+        else:
+            # Appended: only upload the new part, with the header of the file
+            part = upload[3] + 1
+            end_offset = records[-1][4][offset_index] if records else stat.st_size
+            delta_path = write_delta_file(file_path, delta_offset, end_offset, part)
+            put_file(session, delta_path, stage, end_offset - delta_offset)
+            os.remove(delta_path)
+
+        uploads[(stage, file_path)] = get_upload(stage, file_path, records, offset_index, part)
+        write_upload_manifest(uploads)
+
+    print(f'Skipped {num_unchanged} unchanged files')
+
+
+def get_upload_files(format='csv'):
+    # (stage, local file, table, file with the conversion manifest, index of the file in its manifest offsets)
+    upload_files = [
+        (config.csv_stage, f'{BASE_PATH}ConditionNames_SNOMED-CT.csv', config.dim_disease_info, None, 0),
+        (config.csv_stage, 'csv_files/fact_patient.csv', config.fact_patient, 'csv_files/fact_patient.csv', 0),
+        (config.csv_stage, 'csv_files/dim_disease.csv', config.dim_disease, 'csv_files/fact_patient.csv', 1)
+    ]
+    for i in range(local_functions.NUM_DIM_LEAD_FILES):
+        if format == 'parquet':
+            file_path, table = local_functions.get_dim_lead_parquet_file_path(i), config.dim_lead
+        elif format == 'wide':
+            file_path, table = local_functions.get_dim_lead_wide_file_path(i), config.dim_lead_wide
+        else:
+            file_path, table = local_functions.get_dim_lead_file_path(i), config.dim_lead
+        upload_files.append((get_lead_stage(format), file_path, table, file_path, 0))
+    return upload_files
+
+
+def get_loaded_records(format='csv'):
+    # {patient_id: md5 of the .mat file} of the records in the lead files of a format, from their manifests
+    records = {}
+    for _, _, table, manifest_path, _ in get_upload_files(format):
+        if table in (config.dim_lead, config.dim_lead_wide):
+            records.update((os.path.basename(entry[0]), entry[3])
+                           for entry in local_functions.read_manifest(manifest_path) or [])
+    return records
+
+
+def get_lead_stage(format='csv'):
+    if format == 'parquet':
+        return config.parquet_stage_lead
+    elif format == 'wide':
+        return config.csv_stage_lead_wide
+    return config.csv_stage_lead
+
+
+def get_delta_offset(upload, records, offset_index, appendable=True):
+    # The uploaded part of a file is still valid when the records it held are still the first records of the
+    # file, then only the bytes after it have to be uploaded. Returns None when the whole file has to be uploaded.
+    if upload is None or records is None or not appendable:
+        return None
+    _, _, offset, _, num_records, records_md5, _ = upload
+    if num_records == 0 or len(records) < num_records or get_records_md5(records[:num_records]) != records_md5:
+        return None
+    if records[num_records - 1][4][offset_index] != offset:
+        return None
+    return offset
+
+
+def get_upload(stage, file_path, records, offset_index, part):
+    # The manifest entry of a file that is uploaded up to its last committed record
+    stat = os.stat(file_path)
+    offset = records[-1][4][offset_index] if records else stat.st_size
+    records = records or []
+    patient_ids = [os.path.basename(record[0]) for record in records]
+    return [stat.st_size, stat.st_mtime_ns, offset, part, len(records), get_records_md5(records), patient_ids]
+
+
+def get_records_md5(records):
+    return hashlib.md5('\n'.join(f'{record[0]},{record[3]}' for record in records).encode()).hexdigest()
+
+
+def read_upload_manifest():
+    uploads = {}
+    if os.path.exists(UPLOAD_MANIFEST_PATH):
+        with open(UPLOAD_MANIFEST_PATH, 'r', newline='') as manifest_file:
+            reader = csv.reader(manifest_file)
+            next(reader)
+            for stage, file_path, size, mtime, offset, part, num_records, records_md5, patient_ids in reader:
+                uploads[(stage, file_path)] = [int(size), int(mtime), int(offset), int(part), int(num_records),
+                                               records_md5, patient_ids.split()]
+    return uploads
+
+
+def write_upload_manifest(uploads):
+    Path(UPLOAD_MANIFEST_PATH).parent.mkdir(parents=True, exist_ok=True)
+    local_functions.replace_csv_file(UPLOAD_MANIFEST_PATH, UPLOAD_MANIFEST_HEADER,
+                                     [[stage, file_path] + upload[:6] + [' '.join(upload[6])]
+                                      for (stage, file_path), upload in uploads.items()])
+
+
+def write_delta_file(file_path, start_offset, end_offset, part):
+    # Copy the header and the bytes [start_offset, end_offset) of a file to a new part file
+    stem, suffix = os.path.splitext(os.path.basename(file_path))
+    delta_path = os.path.join(DELTA_DIRECTORY, f'{stem}_delta_{part:04d}{suffix}')
+    with open(file_path, 'rb') as source_file, open(delta_path, 'wb') as delta_file:
+        delta_file.write(source_file.readline())
+        source_file.seek(start_offset)
+        remaining = end_offset - start_offset
+        while remaining > 0:
+            chunk = source_file.read(min(remaining, 1 << 24))
+            delta_file.write(chunk)
+            remaining -= len(chunk)
+    return delta_path
+
+
+def put_file(session, file_path, stage, num_bytes):
+    # Parquet files are already compressed, so they are uploaded as they are
+    compress = 'FALSE' if file_path.endswith('.parquet') else 'TRUE'
+    windows_path = file_path.replace('/', '\\')
+    sql_statement = (
+        f'PUT file://C:{windows_path} '
+        f'@{stage} '
+        f'AUTO_COMPRESS = {compress} '
+        f'SOURCE_COMPRESSION = NONE '
+        f'OVERWRITE = TRUE')
+
+    execute_sql_statement_with_message(session, sql_statement,
+                                       f'Uploaded {os.path.basename(file_path)} ({num_bytes} bytes)')
+
+
+def remove_staged_deltas(session, stage, file_path=None):
+    # Remove the parts of one file, or of all files, from a stage
+    if file_path is None:
+        session.sql(f'REMOVE @{stage} PATTERN = \'.*_delta_[0-9]+[.].*\'').collect()
+    else:
+        stem = os.path.splitext(os.path.basename(file_path))[0]
+        session.sql(f'REMOVE @{stage}/{stem}_delta_').collect()
+
+
+def delete_loaded_rows(session, table, patient_ids=None):
+    # Delete the rows that were loaded from a file, a file without patients is the only source of its table
+    if patient_ids is None:
+        session.sql(f'DELETE FROM {table}').collect()
+        return
+    for i in range(0, len(patient_ids), 10000):
+        id_list = ', '.join(f'\'{patient_id}\'' for patient_id in patient_ids[i:i + 10000])
+        session.sql(f'DELETE FROM {table} WHERE patient_id IN ({id_list})').collect()
+
+        # They are aggregated again when their new rows are loaded
+        session.sql(f'DELETE FROM {config.table_tensions_diseases} WHERE patient_id IN ({id_list})').collect()
+
+
 def execute_sql_statement_with_message(session, sql_statement, message):
     start_time = datetime.now()
     result = session.sql(sql_statement).collect()
@@ -214,7 +535,7 @@ def execute_sql_statement_with_message(session, sql_statement, message):
     return result
 
 
-def copy_all_files_into_tables(session):
+def copy_all_files_into_tables(session, format='csv'):
     sql_statement = (
         f'COPY INTO {config.dim_disease_info} '
         f'FROM @{config.csv_stage}/ConditionNames_SNOMED-CT.csv.gz '
@@ -224,24 +545,46 @@ def copy_all_files_into_tables(session):
 
     sql_statement = (
         f'COPY INTO {config.fact_patient} FROM ('
-        f'SELECT $1, $2, $3 FROM @{config.csv_stage}/fact_patient.csv.gz) '
+        f'SELECT $1, $2, $3 FROM @{config.csv_stage}/fact_patient) '
         f'FILE_FORMAT = (FORMAT_NAME = \'{config.csv_format}\')')
 
     execute_sql_statement_with_message(session, sql_statement, "Copied patient.csv.gz in table")
 
     sql_statement = (
         f'COPY INTO {config.dim_disease} FROM ('
-        f'SELECT $1, $2 FROM @{config.csv_stage}/dim_disease.csv.gz) '
+        f'SELECT $1, $2 FROM @{config.csv_stage}/dim_disease) '
         f'FILE_FORMAT = (FORMAT_NAME = \'{config.csv_format}\')')
 
     execute_sql_statement_with_message(session, sql_statement, "Copied dim_disease.csv.gz in table")
 
-    sql_statement = (
-        f'COPY INTO {config.dim_lead} FROM ('
-        f'SELECT $1, $2, $3 FROM @{config.csv_stage_lead}/) '
-        f'FILE_FORMAT = (FORMAT_NAME = \'{config.csv_format}\')')
+    # With an ordered load the long layout is copied into the staging table first
+    lead_table = config.dim_lead_staging if config.dim_lead_ordered_load else config.dim_lead
+
+    if format == 'parquet':
+        sql_statement = (
+            f'COPY INTO {lead_table} FROM ('
+            f'SELECT $1:PATIENT_ID::VARCHAR, $1:TIMESTAMP::NUMBER, $1:TENSION::NUMBER '
+            f'FROM @{config.parquet_stage_lead}/) '
+            f'FILE_FORMAT = (FORMAT_NAME = \'{config.parquet_format}\')')
 
-    execute_sql_statement_with_message(session, sql_statement, "Copied dim_lead_*.csv.gz in table")
+        execute_sql_statement_with_message(session, sql_statement, "Copied dim_lead_*.parquet in table")
+    elif format == 'wide':
+        sql_statement = (
+            f'COPY INTO {config.dim_lead_wide} FROM ('
+            f'SELECT $1, TO_BINARY($2, \'BASE64\') FROM @{config.csv_stage_lead_wide}/) '
+            f'FILE_FORMAT = (FORMAT_NAME = \'{config.csv_format}\')')
+
+        execute_sql_statement_with_message(session, sql_statement, "Copied dim_lead_wide_*.csv.gz in table")
+    else:
+        sql_statement = (
+            f'COPY INTO {lead_table} FROM ('
+            f'SELECT $1, $2, $3 FROM @{config.csv_stage_lead}/) '
+            f'FILE_FORMAT = (FORMAT_NAME = \'{config.csv_format}\')')
+
+        execute_sql_statement_with_message(session, sql_statement, "Copied dim_lead_*.csv.gz in table")
+
+    if format != 'wide' and config.dim_lead_ordered_load:
+        insert_staged_leads(session)
 
     sql_statement = (f'DELETE FROM {config.dim_disease} '
                      f'WHERE disease_info_id NOT IN ('
@@ -250,6 +593,24 @@ def copy_all_files_into_tables(session):
     session.sql(sql_statement).collect()
 
 
+def insert_staged_leads(session):
+    # Every lead file holds every 256th record, copied as they are the rows of a patient would end up next to
+    # other patients in one micro-partition of every file. Inserted in (patient_id, timestamp) order they share a
+    # few micro-partitions, which is the order the clustering key keeps up for later loads.
+    session.sql('BEGIN TRANSACTION').collect()
+    try:
+        sql_statement = (f'INSERT INTO {config.dim_lead} '
+                         f'SELECT patient_id, timestamp, tension FROM {config.dim_lead_staging} '
+                         f'ORDER BY patient_id, timestamp')
+        execute_sql_statement_with_message(session, sql_statement, 'Inserted the copied leads in patient order')
+        # DELETE keeps the load history of the staging table, TRUNCATE would forget which files were loaded
+        session.sql(f'DELETE FROM {config.dim_lead_staging}').collect()
+        session.sql('COMMIT').collect()
+    except Exception:
+        session.sql('ROLLBACK').collect()
+        raise
+
+
 def upload_import_file(session, file_path, stage):
     sql_statement = (
         f'PUT file://C:{file_path} '
@@ -273,8 +634,11 @@ def create_stored_procedure_train_model(session, module, function, return_type,
                      f'RETURNS {return_type} ' \
                      f'LANGUAGE PYTHON ' \
                      f'RUNTIME_VERSION = \'3.8\' ' \
-                     f'PACKAGES = (\'snowflake-snowpark-python\', \'pandas\', \'scikit-learn\', \'tensorflow\') ' \
+                     f'PACKAGES = (\'snowflake-snowpark-python\', \'pandas\', \'scikit-learn\', \'scipy\', ' \
+                     f'\'tensorflow\') ' \
                      f'imports = (\'@{config.functions_stage}/model_functions.py\', ' \
+                     f'\'@{config.functions_stage}/bulk_functions.py\', ' \
+                     f'\'@{config.functions_stage}/signal_functions.py\', ' \
                      f'\'@{config.functions_stage}/config.py\') ' \
                      f'HANDLER = \'{module}.{function}\''
 
@@ -293,8 +657,11 @@ def create_stored_procedure_predict(session, module, function, return_type, para
                      f'RETURNS {return_type} ' \
                      f'LANGUAGE PYTHON ' \
                      f'RUNTIME_VERSION = \'3.8\' ' \
-                     f'PACKAGES = (\'snowflake-snowpark-python\', \'pandas\', \'scikit-learn\', \'tensorflow\') ' \
+                     f'PACKAGES = (\'snowflake-snowpark-python\', \'pandas\', \'scikit-learn\', \'scipy\', ' \
+                     f'\'tensorflow\') ' \
                      f'imports = (\'@{config.functions_stage}/model_functions.py\', ' \
+                     f'\'@{config.functions_stage}/bulk_functions.py\', ' \
+                     f'\'@{config.functions_stage}/signal_functions.py\', ' \
                      f'\'@{config.functions_stage}/config.py\', ' \
                      f'\'@{config.models_stage}/my_model.h5\') ' \
                      f'HANDLER = \'{module}.{function}\''
@@ -302,6 +669,13 @@ def create_stored_procedure_predict(session, module, function, return_type, para
     execute_sql_statement_with_message(session, sql_statement, f'Created stored procedure {function}')
 
 
+@query_cache.cached(lambda: [(config.models_stage,)], ttl=config.model_version_ttl)
+def get_model_version(session):
+    # The md5 of the staged model identifies the model the predict procedures use, None without a model
+    rows = session.sql(f'LIST @{config.models_stage}/my_model.h5').collect()
+    return rows[0][2] if rows else None
+
+
 def call_procedure(session, function_name):
     sql_statement = (
         f'CALL '
@@ -319,23 +693,84 @@ def call_procedure_with_parameters(session, function_name, parameters):
 
 
 def get_next_patient_id(session):
-    query = session.sql(
-        f'SELECT MAX(patient_id) AS max FROM {config.fact_patient}'
-    )
-    df = query.to_pandas()
-    id = df["MAX"].iloc[0]
-    if id is None:
-        id = 'JS1'
-    id = str((int(id[2:]) + 1))
-    return f'JS{id.zfill(5)}'
+    return get_next_patient_ids(session, 1)[0]
+
+
+def get_next_patient_ids(session, num_patients):
+    # A sequence never hands out the same value twice, so concurrent uploads get different patient_ids
+    rows = session.sql(f'SELECT {config.patient_id_sequence}.NEXTVAL '
+                       f'FROM TABLE(GENERATOR(ROWCOUNT => {num_patients}))').collect()
+    return [f'JS{int(row[0]):05d}' for row in rows]
+
+
+def ingest_patients(time_series_list, user_id, session):
+    # Add uploaded ECGs as new patients of a user. The patient, lead and ownership rows of all ECGs are staged as
+    # one batch and copied into their tables in one transaction, so a failed upload adds nothing. The number of
+    # statements does not depend on the number of ECGs or on the size of the tables.
+    patient_ids = get_next_patient_ids(session, len(time_series_list))
+    batch = f'{config.csv_stage}/{INGEST_PREFIX}{uuid.uuid4().hex}/'
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_ingest_files(directory, patient_ids, time_series_list, user_id)
+        session.file.put(os.path.join(directory, '*'), f'@{batch}', auto_compress=True, overwrite=True)
+
+    if config.lead_layout == 'wide':
+        lead_table, lead_columns = config.dim_lead_wide, '$1, TO_BINARY($2, \'BASE64\')'
+    else:
+        lead_table, lead_columns = config.dim_lead, '$1, $2, $3'
+
+    session.sql('BEGIN TRANSACTION').collect()
+    try:
+        for table, columns, file_name in [(config.fact_patient, '$1, $2, $3', 'fact_patient'),
+                                          (lead_table, lead_columns, 'dim_lead'),
+                                          (config.table_patient_user, '$1, $2', 'patient_user')]:
+            session.sql(f'COPY INTO {table} FROM ('
+                        f'SELECT {columns} FROM @{batch}{file_name}) '
+                        f'FILE_FORMAT = (FORMAT_NAME = \'{config.csv_format}\') '
+                        f'PURGE = TRUE').collect()
+        session.sql('COMMIT').collect()
+    except Exception:
+        session.sql('ROLLBACK').collect()
+        session.sql(f'REMOVE @{batch}').collect()
+        raise
+
+    query_cache.invalidate((config.table_patient_user, user_id))
+    for patient_id in patient_ids:
+        invalidate_patient(patient_id)
+    return patient_ids
+
+
+def write_ingest_files(directory, patient_ids, time_series_list, user_id):
+    # Csv files with a header line, like the files of the csv stage format
+    with open(os.path.join(directory, 'fact_patient.csv'), 'w', newline='') as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(['PATIENT_ID', 'AGE', 'GENDER'])
+        csv_writer.writerows([patient_id, 1, 'X'] for patient_id in patient_ids)
+
+    with open(os.path.join(directory, 'dim_lead.csv'), 'w', newline='') as csv_file:
+        csv_writer = csv.writer(csv_file)
+        if config.lead_layout == 'wide':
+            csv_writer.writerow(['PATIENT_ID', 'TENSIONS'])
+            csv_writer.writerows([patient_id, local_functions.encode_tensions(time_series)]
+                                 for patient_id, time_series in zip(patient_ids, time_series_list))
+        else:
+            # The same rows as the dim_lead_*.csv files of the conversion
+            csv_writer.writerow(['PATIENT_ID', 'TIMESTAMP', 'TENSION'])
+            for patient_id, time_series in zip(patient_ids, time_series_list):
+                csv_file.write(local_functions.format_mat_rows(patient_id, time_series))
+
+    with open(os.path.join(directory, 'patient_user.csv'), 'w', newline='') as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(['PATIENT_ID', 'USER_ID'])
+        csv_writer.writerows([patient_id, user_id] for patient_id in patient_ids)
 
 
 def login(username, password, session):
     query = session.sql(
         f'SELECT user_id AS id '
         f'FROM {config.table_user} WHERE '
-        f'username = \'{username}\' '
-        f'AND password = \'{password}\''
+        f'username = {bulk_functions.format_string(username)} '
+        f'AND password = {bulk_functions.format_string(password)}'
     )
     df = query.to_pandas()
     if len(df["ID"]) == 0:
@@ -346,17 +781,16 @@ def login(username, password, session):
 
 
 def register(firstname, lastname, username, password, session):
-    session.sql(
-        f'INSERT INTO {config.table_user}(firstname, lastname, username, password) '
-        f'VALUES(\'{firstname}\', \'{lastname}\', \'{username}\', \'{password}\')'
-    ).collect()
+    bulk_functions.insert_rows(session, config.table_user, ['firstname', 'lastname', 'username', 'password'],
+                               [[firstname, lastname, username, password]])
 
 
 def add_patient_to_user(patient_id, user_id, session):
-    session.sql(f'INSERT INTO {config.table_patient_user} '
-                f'VALUES (\'{patient_id}\', {user_id})').collect()
+    bulk_functions.insert_rows(session, config.table_patient_user, ['patient_id', 'user_id'], [[patient_id, user_id]])
+    query_cache.invalidate((config.table_patient_user, user_id))
 
 
+@query_cache.cached(lambda user_id: [(config.table_patient_user, user_id)])
 def get_all_patients(user_id, session):
     query = session.sql(f'SELECT patient_id AS id '
                         f'FROM {config.table_patient_user} '
@@ -375,22 +809,40 @@ def update_patient(age, gender, patient_id, session):
         f'UPDATE {config.fact_patient} '
         f'SET age = {age}, gender = \'{gender}\' '
         f'WHERE patient_id = \'{patient_id}\'').collect()
+    invalidate_patient(patient_id)
+
+
+def invalidate_patient(patient_id):
+    # The cached rows of a new or changed patient
+    query_cache.invalidate((config.fact_patient, patient_id), (config.dim_lead, patient_id))
 
 
+@query_cache.cached(lambda patient_id: [(config.dim_lead, patient_id)])
 def get_tensions(patient_id, session):
+    # Records are sliced from the local memory-mapped store while it holds the loaded records
+    tensions = store_functions.get_local_ecg(patient_id)
+    if tensions is not None:
+        return tensions
+
+    if config.lead_layout == 'wide':
+        return get_wide_tensions(patient_id, session)
+
     query = session.sql(
         f'SELECT l.tension FROM {config.dim_lead} AS l WHERE patient_id = \'{patient_id}\' ORDER BY l.timestamp')
     df = query.to_pandas()
-    data = []
-    for i in range(12):
-        lead = []
-        for j in range(5000):
-            lead.append(df["TENSION"].iloc[i * 5000 + j])
-        data.append(lead)
 
-    return data
+    # The rows are ordered by timestamp, so the 12 leads of 5000 tensions are a single reshape
+    return df['TENSION'].to_numpy(dtype=np.int16).reshape(12, 5000)
+
+
+def get_wide_tensions(patient_id, session):
+    # Single row lookup of the int16 bytes of a patient
+    tensions = session.sql(
+        f'SELECT tensions FROM {config.dim_lead_wide} WHERE patient_id = \'{patient_id}\'').collect()[0][0]
+    return np.frombuffer(tensions, dtype='<i2').reshape(12, 5000)
 
 
+@query_cache.cached(lambda patient_id: [(config.fact_patient, patient_id)])
 def get_age_and_gender(patient_id, session):
     query = session.sql(f'SELECT age, gender FROM {config.fact_patient} WHERE patient_id = \'{patient_id}\'')
     return query.to_pandas()
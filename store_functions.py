@@ -0,0 +1,172 @@
+import hashlib
+import io
+import os
+import shutil
+from functools import lru_cache
+from multiprocessing import Pool
+
+import numpy as np
+import scipy.io as sc
+from tqdm import tqdm
+
+import header_functions
+
+# Directory of the memory-mapped store with the tensions of all records:
+# tensions.npy is an int16 array of shape (N, 12, 5000), patient_ids.npz maps a patient_id to its row and holds
+# the md5 of the .mat file every row was read from
+ECG_STORE_DIRECTORY = 'ecg_store/'
+
+# File in the store directory with the fingerprint of the store when the warehouse holds the same records.
+# The store is only read while it matches, otherwise the tensions come from the warehouse.
+LOADED_FILE = 'loaded.txt'
+
+# Number of records one worker writes into the store at a time
+STORE_CHUNK_SIZE = 256
+
+
+def build_ecg_store(all_file_paths, processes=1, directory=ECG_STORE_DIRECTORY):
+    # Pack the tensions of all records into one int16 array on disk. The store is built in a temporary
+    # directory that replaces the old store at the end, so readers never see a half written store.
+    # A new store is not used until the load of its records marks it as loaded.
+    build_directory = directory.rstrip('/\\') + '.tmp'
+    shutil.rmtree(build_directory, ignore_errors=True)
+    os.makedirs(build_directory)
+
+    tensions_path = os.path.join(build_directory, 'tensions.npy')
+    np.lib.format.open_memmap(tensions_path, mode='w+', dtype=np.int16, shape=(len(all_file_paths), 12, 5000)).flush()
+
+    # Every worker writes its own rows straight into the memory-mapped file
+    chunks = [(tensions_path, start, all_file_paths[start:start + STORE_CHUNK_SIZE])
+              for start in range(0, len(all_file_paths), STORE_CHUNK_SIZE)]
+    md5s = np.empty(len(all_file_paths), dtype='U32')
+    if processes > 1:
+        with Pool(processes) as pool:
+            for start, chunk_md5s in tqdm(pool.imap_unordered(write_store_rows, chunks), total=len(chunks),
+                                          desc=f'Building the ECG store with {processes} processes...'):
+                md5s[start:start + len(chunk_md5s)] = chunk_md5s
+    else:
+        for chunk in tqdm(chunks, desc='Building the ECG store...'):
+            start, chunk_md5s = write_store_rows(chunk)
+            md5s[start:start + len(chunk_md5s)] = chunk_md5s
+
+    patient_ids = np.array([os.path.basename(file_path) for file_path in all_file_paths], dtype='U7')
+    np.savez(os.path.join(build_directory, 'patient_ids.npz'), patient_ids=patient_ids,
+             patient_order=np.argsort(patient_ids).astype(np.int32), md5s=md5s)
+
+    # The old store is moved aside before the new one takes its place, so there is a store at every moment a
+    # crash can happen. Readers that still map the old files keep their mapping until they load the new store.
+    directory = directory.rstrip('/\\')
+    old_directory = directory + '.old'
+    shutil.rmtree(old_directory, ignore_errors=True)
+    if os.path.exists(directory):
+        os.replace(directory, old_directory)
+    os.replace(build_directory, directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+
+
+def write_store_rows(chunk):
+    # Returns the start row and the md5 of the .mat file of every written row
+    tensions_path, start, file_paths = chunk
+    tensions = np.load(tensions_path, mmap_mode='r+')
+    md5s = []
+    for i, file_path in enumerate(file_paths):
+        with open(f'{file_path}.mat', 'rb') as mat_file:
+            content = mat_file.read()
+        tensions[start + i] = sc.loadmat(io.BytesIO(content))['val'][:12, :5000]
+        md5s.append(hashlib.md5(content).hexdigest())
+    tensions.flush()
+    return start, md5s
+
+
+def has_ecg_store(directory=ECG_STORE_DIRECTORY):
+    # A store is only used while it holds the same records as the warehouse
+    loaded_path = os.path.join(directory, LOADED_FILE)
+    if not os.path.exists(os.path.join(directory, 'patient_ids.npz')) or not os.path.exists(loaded_path):
+        return False
+    with open(loaded_path, 'r') as loaded_file:
+        return loaded_file.read() == load_ecg_store(directory)['fingerprint']
+
+
+def load_ecg_store(directory=ECG_STORE_DIRECTORY):
+    # A rebuilt store has another mtime, so it is read again instead of the mapping of the replaced files
+    return read_ecg_store(directory, os.stat(os.path.join(directory, 'patient_ids.npz')).st_mtime_ns)
+
+
+@lru_cache(maxsize=1)
+def read_ecg_store(directory, mtime):
+    # Only the patient index is read into memory, the tensions stay on disk until a record is sliced
+    with np.load(os.path.join(directory, 'patient_ids.npz')) as arrays:
+        store = {key: arrays[key] for key in arrays.files}
+    store['tensions'] = np.load(os.path.join(directory, 'tensions.npy'), mmap_mode='r')
+    # Stores built before the md5s were kept can never be marked as loaded
+    store['fingerprint'] = get_fingerprint(zip(store['patient_ids'], store['md5s'])) if 'md5s' in store else None
+    return store
+
+
+def get_fingerprint(records):
+    # md5 over the (patient_id, md5 of the .mat file) pairs of a set of records, in any order
+    md5 = hashlib.md5()
+    for patient_id, record_md5 in sorted((str(patient_id), str(record_md5)) for patient_id, record_md5 in records):
+        md5.update(f'{patient_id} {record_md5}\n'.encode('ascii'))
+    return md5.hexdigest()
+
+
+def mark_ecg_store_loaded(loaded_records, directory=ECG_STORE_DIRECTORY):
+    # Called after a load with the {patient_id: md5} of the records the warehouse now holds. The store is marked
+    # as loaded when it holds exactly these records, otherwise it is left unused. Returns whether it is marked.
+    forget_ecg_store_load(directory)
+    if not os.path.exists(os.path.join(directory, 'patient_ids.npz')):
+        return False
+    fingerprint = load_ecg_store(directory)['fingerprint']
+    if get_fingerprint(loaded_records.items()) != fingerprint:
+        return False
+
+    loaded_path = os.path.join(directory, LOADED_FILE)
+    with open(f'{loaded_path}.tmp', 'w') as loaded_file:
+        loaded_file.write(fingerprint)
+    os.replace(f'{loaded_path}.tmp', loaded_path)
+    return True
+
+
+def forget_ecg_store_load(directory=ECG_STORE_DIRECTORY):
+    # Stop using the store, e.g. while the warehouse is being reloaded
+    if os.path.exists(os.path.join(directory, LOADED_FILE)):
+        os.remove(os.path.join(directory, LOADED_FILE))
+
+
+def get_max_patient_id(directory=ECG_STORE_DIRECTORY):
+    # Highest patient_id in the store, loaded or not, or None without a store
+    if not os.path.exists(os.path.join(directory, 'patient_ids.npz')):
+        return None
+    store = load_ecg_store(directory)
+    return None if len(store['patient_ids']) == 0 else str(store['patient_ids'][store['patient_order'][-1]])
+
+
+def get_ecg(store, patient_id):
+    # Zero-copy (12, 5000) view of the tensions of a patient, or None for a patient that is not in the store
+    i = header_functions.get_patient_position(store, patient_id)
+    return None if i is None else store['tensions'][i]
+
+
+def get_ecgs(store, patient_ids):
+    # The tensions of many patients as a (n, 12, 5000) array, patients that are not in the store are left out
+    positions = [header_functions.get_patient_position(store, patient_id) for patient_id in patient_ids]
+    found_ids = [patient_id for patient_id, i in zip(patient_ids, positions) if i is not None]
+    return found_ids, store['tensions'][[i for i in positions if i is not None]]
+
+
+def has_patients(store, patient_ids):
+    return all(header_functions.get_patient_position(store, patient_id) is not None for patient_id in patient_ids)
+
+
+def get_local_ecg(patient_id, directory=ECG_STORE_DIRECTORY):
+    # Tensions of a patient from the local store, None without a store or for a patient that is not in it
+    if not has_ecg_store(directory):
+        return None
+    return get_ecg(load_ecg_store(directory), patient_id)
+
+
+def get_training_tensions(store, patient_ids):
+    # A batch of flattened float32 tensions in the order of patient_ids
+    _, tensions = get_ecgs(store, list(patient_ids))
+    return tensions.reshape(len(tensions), -1).astype(np.float32)